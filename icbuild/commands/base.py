@@ -55,6 +55,9 @@ class cmd_build(BuildCommand):
             make_option('-t', '--start-at', metavar='MODULE',
                         action='store', dest='startat', default=None,
                         help='start building at the given module'),
+            make_option('--resume',
+                        action='store_true', dest='resume', default=False,
+                        help='resume an interrupted build where it stopped'),
             make_option('-f', '--force',
                         action='store_true', dest='force_policy', default=False,
                         help='build even if policy says not to'),
@@ -62,6 +65,10 @@ class cmd_build(BuildCommand):
                         action='store', dest='arch', default='Win32',
                         choices=['Win32', 'x64'],
                         help='build for a specific architecture'),
+            make_option('-p', '--parallel-modules', metavar='N',
+                        action='store', type='int', dest='parallel_modules',
+                        default=None,
+                        help='build up to N independent modules at once'),
             ])
 
     def run(self, config, options, args, help=None):
@@ -87,7 +94,7 @@ class cmd_build(BuildCommand):
             return 0
 
         build = icbuild.frontends.get_buildscript(config, module_list, module_set=module_set)
-        return build.build()
+        return build.build(journal=True)
 
 register_command(cmd_build)
 
@@ -113,6 +120,10 @@ class cmd_buildone(BuildCommand):
                         action='store', dest='arch', default='Win32',
                         choices=['Win32', 'x64'],
                         help='build for a specific architecture'),
+            make_option('-p', '--parallel-modules', metavar='N',
+                        action='store', type='int', dest='parallel_modules',
+                        default=None,
+                        help='build up to N independent modules at once'),
             ])
 
     def run(self, config, options, args, help=None):
@@ -0,0 +1,75 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   cache.py: manage the download caches
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from optparse import make_option
+
+import icbuild.moduleset
+from icbuild.errors import FatalError, UsageError
+from icbuild.commands import Command, register_command
+from icbuild.utils import cachegc
+
+
+class cmd_cache(Command):
+    doc = 'Manage the cache of downloaded files'
+
+    name = 'cache'
+    usage_args = '[ options ... ] gc'
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('--max-size', metavar='SIZE',
+                        action='store', dest='max_size', default=None,
+                        help='remove files until the cache takes at most '
+                             'SIZE bytes, with an optional K, M, G or T '
+                             'suffix (default: the cache_max_size setting)'),
+            make_option('-n', '--dry-run',
+                        action='store_true', dest='dry_run', default=False,
+                        help='only list the files that would be removed'),
+            make_option('-v', '--verbose',
+                        action='store_true', dest='verbose', default=False,
+                        help='list the files removed'),
+            ])
+
+    def run(self, config, options, args, help=None):
+        if args != ['gc']:
+            raise UsageError('usage: icbuild cache %s' % self.usage_args)
+
+        if options.max_size is not None:
+            max_size = cachegc.parse_size(options.max_size)
+        elif config.cache_max_size is not None:
+            max_size = config.cache_max_size
+        else:
+            raise FatalError('no cache size given; set cache_max_size '
+                             'or use --max-size')
+
+        # the files of the current modulesets are kept
+        module_set = icbuild.moduleset.load(config)
+        removed = cachegc.collect(config, module_set, max_size=max_size,
+                                  dry_run=options.dry_run)
+
+        if options.verbose or options.dry_run:
+            for path, size in removed:
+                uprint('%s (%s)' % (path, cachegc.format_size(size)))
+        freed = cachegc.format_size(sum([size for path, size in removed]))
+        if options.dry_run:
+            uprint('%d files would be removed, freeing %s' % (len(removed), freed))
+        else:
+            uprint('%d files removed, freeing %s' % (len(removed), freed))
+        return 0
+
+register_command(cmd_cache)
@@ -0,0 +1,62 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   freeze.py: write a lock file of the current moduleset
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import logging
+from optparse import make_option
+
+import icbuild.moduleset
+from icbuild.commands import Command, register_command
+from icbuild.utils import lockfile
+
+
+class cmd_freeze(Command):
+    doc = 'Write a lock file of the modules and their build order'
+
+    name = 'freeze'
+    usage_args = '[ options ... ] [ modules ... ]'
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('-o', '--output', metavar='FILE',
+                        action='store', dest='output', default=None,
+                        help='write the lock file to FILE (default: the '
+                             'lockfile setting, or standard output)'),
+            make_option('-s', '--skip', metavar='MODULES',
+                        action='append', dest='skip', default=[],
+                        help='treat the given modules as up to date'),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        if args:
+            config.modules = args
+
+        module_set = icbuild.moduleset.load(config, use_lockfile=False)
+        data = icbuild.moduleset.freeze(config, module_set)
+
+        filename = options.output or config.lockfile
+        if filename:
+            lockfile.write(filename, data)
+            logging.info('wrote %d modules to %s' % (len(data['modules']), filename))
+        else:
+            uprint(json.dumps(dict(data, version=lockfile.VERSION),
+                              indent=1, sort_keys=True))
+        return 0
+
+register_command(cmd_freeze)
@@ -84,16 +84,14 @@ class cmd_info(Command):
         # dependencies
         if module.dependencies:
             uprint('Requires:', ', '.join(module.dependencies))
-        requiredby = [ mod.name for mod in module_set.modules.values()
-                       if module.name in mod.dependencies ]
+        requiredby = module_set.get_reverse_dependencies(module.name)
         if requiredby:
             uprint('Required by:', ', '.join(requiredby))
         if module.suggests:
             uprint('Suggests:', ', '.join(module.suggests))
         if module.after:
             uprint('After:', ', '.join(module.after))
-        before = [ mod.name for mod in module_set.modules.values()
-                   if module.name in mod.after ]
+        before = module_set.get_reverse_after(module.name)
         if before:
             uprint('Before:', ', '.join(before))
 
@@ -0,0 +1,194 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   plan.py: show what a build would do, without doing it
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import logging
+from optparse import make_option
+
+import icbuild.moduleset
+from icbuild.errors import FatalError, CommandError, BuildStateError
+from icbuild.commands import Command, register_command
+from icbuild.frontends import buildscript
+
+
+class PlanBuildScript(buildscript.BuildScript):
+    '''A build script that does not run anything; it keeps the messages
+    (e.g. the reasons given by the build policy for skipping modules).'''
+
+    def __init__(self, config, module_list, module_set=None):
+        buildscript.BuildScript.__init__(self, config, module_list, module_set=module_set)
+        self.messages = []
+
+    def _prepare_directories(self):
+        # planning changes nothing on disk
+        pass
+
+    def message(self, msg, module_num=-1):
+        self.messages.append(msg)
+
+    def set_action(self, action, module, module_num=-1, action_target=None):
+        pass
+
+    def execute(self, command, hint=None, cwd=None, extra_env=None):
+        raise CommandError('not running commands while planning')
+
+    def handle_error(self, module, phase, nextphase, error, altphases):
+        return 'fail'
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+
+class cmd_plan(Command):
+    doc = 'Show which modules and phases a build would run'
+
+    name = 'plan'
+    usage_args = '[ options ... ] [ modules ... ]'
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('-c', '--clean',
+                        action='store_true', dest='clean', default=False,
+                        help='clean before building'),
+            make_option('-s', '--skip', metavar='MODULES',
+                        action='append', dest='skip', default=[],
+                        help='treat the given modules as up to date'),
+            make_option('-t', '--start-at', metavar='MODULE',
+                        action='store', dest='startat', default=None,
+                        help='start building at the given module'),
+            make_option('-f', '--force',
+                        action='store_true', dest='force_policy', default=False,
+                        help='build even if policy says not to'),
+            make_option('-p', '--parallel-modules', metavar='N',
+                        action='store', type='int', dest='parallel_modules',
+                        default=None,
+                        help='build up to N independent modules at once'),
+            make_option('--json',
+                        action='store_true', dest='json', default=False,
+                        help='output the plan as JSON'),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+
+        module_set = icbuild.moduleset.load(config)
+        modules = args or config.modules
+        full_module_list = module_set.get_full_module_list \
+                               (modules, config.skip,
+                                include_suggests=not config.ignore_suggests)
+        module_list = module_set.remove_tag_modules(full_module_list,
+                                                    config.tags)
+        if options.startat:
+            while module_list and module_list[0].name != options.startat:
+                del module_list[0]
+            if not module_list:
+                raise FatalError('%s not in module list' % options.startat)
+
+        build = PlanBuildScript(config, module_list, module_set=module_set)
+        build._estimate_modules()
+        plan = [self.plan_module(build, module) for module in module_list]
+
+        costs = dict([(entry['module'], entry['action'] != 'skip' and
+                                        entry['estimate'] or 0)
+                      for entry in plan])
+        work = sum(costs.values())
+        have_estimates = bool(build._module_estimates)
+        # the modules of a dependency chain are built one after the other,
+        # however many can run at once
+        critical_paths = build._get_critical_paths(build._get_waiting_on(), costs)
+        duration = max(work / max(config.max_concurrent_modules, 1),
+                       max(list(critical_paths.values()) or [0]))
+
+        if options.json:
+            uprint(json.dumps({
+                'modules': plan,
+                'estimated-work': have_estimates and work or None,
+                'estimated-duration': have_estimates and duration or None,
+                }, indent=2))
+            return 0
+
+        for entry in plan:
+            if entry['action'] == 'skip':
+                details = '(%s)' % entry['reason']
+            else:
+                details = ', '.join(entry['phases'])
+                if entry['action'] == 'restore':
+                    details = 'restore from artifact cache'
+                if entry['estimate'] is not None:
+                    details += ' [%s]' % format_duration(entry['estimate'])
+            uprint('  %-8s %-25s %s' % (entry['action'], entry['module'], details))
+        num_built = len([x for x in plan if x['action'] != 'skip'])
+        uprint('%d modules to build, %d to skip' % (num_built, len(plan) - num_built))
+        if have_estimates:
+            uprint('Estimated duration: %s' % format_duration(duration))
+        else:
+            uprint('Estimated duration: unknown (no build history)')
+        return 0
+
+    def plan_module(self, build, module):
+        '''Return a dictionary describing what building module would do.'''
+        config = build.config
+        phases = build.get_build_phases(module)
+        entry = {'module': module.name,
+                 'phases': phases,
+                 'action': 'build',
+                 'reason': None,
+                 'estimate': build._module_estimates.get(module.name)}
+
+        if config.min_age is not None:
+            installdate = build.moduleset.packagedb.installdate(module.name)
+            if installdate > config.min_age:
+                entry['action'] = 'skip'
+                entry['reason'] = 'installed recently'
+                return entry
+
+        if not phases:
+            entry['action'] = 'skip'
+            entry['reason'] = 'nothing to do'
+            return entry
+
+        # the build policy is checked by the checkout phase
+        if 'checkout' in phases:
+            del build.messages[:]
+            try:
+                policy = module.check_build_policy(build)
+            except (CommandError, BuildStateError, EnvironmentError) as e:
+                logging.info('could not check build policy of %(module)s: %(error)s'
+                             % {'module': module.name, 'error': e})
+                policy = None
+            if policy == module.PHASE_DONE:
+                entry['action'] = 'skip'
+                entry['reason'] = build.messages and build.messages[-1] or 'up to date'
+                return entry
+
+        if build._may_restore_artifact(phases):
+            input_hash = module.get_input_hash(build)
+            installed = build.moduleset.packagedb.get(module.name)
+            if installed and installed.metadata.get('input-hash') == input_hash:
+                # restore_artifact() leaves installed modules alone
+                pass
+            elif input_hash and build.artifacts.has(input_hash):
+                entry['action'] = 'restore'
+                entry['estimate'] = None
+        return entry
+
+register_command(cmd_plan)
@@ -0,0 +1,128 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   rdeps.py: list the modules affected by a change
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import json
+from optparse import make_option
+
+import icbuild.moduleset
+from icbuild.errors import FatalError, UsageError
+from icbuild.commands import Command, register_command
+
+
+# attributes that do not change what gets built
+_ignored_attrs = ('config', 'tags', 'moduleset_name', 'moduleset_uri')
+
+def _signature(value, depth=0):
+    if isinstance(value, (list, tuple)):
+        return [_signature(x, depth) for x in value]
+    if isinstance(value, dict):
+        return sorted([(k, _signature(v, depth)) for k, v in value.items()])
+    if not hasattr(value, '__dict__') or depth > 3:
+        return value
+    return (value.__class__.__name__,
+            sorted([(k, _signature(v, depth + 1)) for k, v in vars(value).items()
+                    if not k.startswith('_') and k not in _ignored_attrs]))
+
+def module_signature(module):
+    '''Return a string standing for the definition of module, its type,
+    dependencies, branch and build arguments, to tell the modules that
+    changed between two modulesets.'''
+    return repr(_signature(module))
+
+
+class cmd_rdeps(Command):
+    doc = 'List the modules to rebuild after the given modules changed'
+
+    name = 'rdeps'
+    usage_args = '[ options ... ] [ changed-modules ... ]'
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('--diff', metavar='MODULESET',
+                        action='store', dest='diff', default=None,
+                        help='treat the modules whose definition differs '
+                             'from the one in MODULESET as changed'),
+            make_option('-s', '--skip', metavar='MODULES',
+                        action='append', dest='skip', default=[],
+                        help='treat the given modules as up to date'),
+            make_option('-t', '--tags', metavar='TAGS',
+                        action='append', dest='tags', default=[],
+                        help='only list modules with one of the given tags'),
+            make_option('--json',
+                        action='store_true', dest='json', default=False,
+                        help='output the result as JSON'),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        if not args and not options.diff:
+            raise UsageError('no changed modules given')
+
+        module_set = icbuild.moduleset.load(config)
+
+        changed = []
+        for modname in args:
+            try:
+                changed.append(module_set.get_module(modname, ignore_case=True).name)
+            except KeyError:
+                raise FatalError('unknown module %s' % modname)
+        removed = []
+        if options.diff:
+            uri = options.diff
+            if os.path.exists(uri):
+                # load() takes relative names for moduleset names
+                uri = os.path.abspath(uri)
+            old_module_set = icbuild.moduleset.load(config, uri=uri)
+            for name, module in module_set.modules.items():
+                old_module = old_module_set.modules.get(name)
+                if (old_module is None or
+                        module_signature(old_module) != module_signature(module)):
+                    changed.append(name)
+            removed = [name for name in old_module_set.modules
+                       if name not in module_set.modules]
+
+        # modules that used to depend on a removed module are affected
+        # too; the reverse index keeps edges to unknown modules
+        seeds = list(changed)
+        for name in removed:
+            seeds.extend(module_set.get_reverse_dependencies(name))
+            if not config.ignore_suggests:
+                seeds.extend([mod.name for mod in module_set.modules.values()
+                              if name in mod.suggests])
+        affected = set(module_set.get_reverse_closure(seeds,
+                include_suggests=not config.ignore_suggests))
+
+        full_module_list = module_set.get_full_module_list(
+                config.modules, config.skip,
+                include_suggests=not config.ignore_suggests)
+        module_list = module_set.remove_tag_modules(full_module_list,
+                                                    config.tags)
+        rebuild = [module.name for module in module_list
+                   if module.name in affected]
+
+        if options.json:
+            uprint(json.dumps({'changed': sorted(set(changed)),
+                               'removed': sorted(removed),
+                               'rebuild': rebuild}, indent=2))
+        else:
+            for name in rebuild:
+                uprint(name)
+        return 0
+
+register_command(cmd_rdeps)
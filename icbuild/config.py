@@ -42,7 +42,8 @@ _defaults_file = os.path.join(os.path.dirname(__file__), 'defaults.icbuildrc')
 _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'partial_build', 'checkoutroot', 'buildroot', 'top_builddir',
                 'msys2dir', 'vs_dir',
-                'makeargs', 'jobs',
+                'makeargs', 'jobs', 'max_concurrent_modules',
+                'prefetch_checkouts',
                 'repos', 'branches',
                 'builddir_pattern', 'module_autogenargs', 'module_makeargs',
                 'interact', 'buildscript', 'nonetwork', 'nobuild',
@@ -57,7 +58,9 @@ _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'build_targets', 'cmakeargs', 'module_cmakeargs',
                 'print_command_pattern',
                 'help_website', 'conditions', 'extra_prefixes',
-                'cacheroot', 'exit_on_error'
+                'cacheroot', 'exit_on_error', 'artifact_cache',
+                'cache_modulesets', 'moduleset_revalidate', 'lockfile',
+                'cache_max_size'
               ]
 
 env_prepends = {}
@@ -172,8 +175,8 @@ class Config:
                     ', '.join(unknown_keys))
 
         for path_key in ('checkoutroot', 'buildroot', 'top_builddir',
-                         'tarballdir', 'copy_dir',
-                         'modulesets_dir',
+                         'tarballdir', 'copy_dir', 'artifact_cache',
+                         'modulesets_dir', 'lockfile',
                          'prefix'):
             if config.get(path_key):
                 config[path_key] = os.path.expanduser(config[path_key])
@@ -217,6 +220,18 @@ class Config:
             raise FatalError('%s must be an absolute path' % 'prefix')
         if not os.path.isabs(self.tarballdir):
             raise FatalError('%s must be an absolute path' % 'tarballdir')
+        if self.max_concurrent_modules < 1:
+            raise FatalError('%s must be at least 1' % 'max_concurrent_modules')
+        if self.moduleset_revalidate not in ('always', 'background'):
+            raise FatalError('invalid moduleset_revalidate value (%s)'
+                             % self.moduleset_revalidate)
+        if self.cache_max_size is not None:
+            from icbuild.utils.cachegc import parse_size
+            try:
+                self.cache_max_size = parse_size(self.cache_max_size)
+            except FatalError:
+                raise FatalError('invalid cache_max_size value (%s)'
+                                 % self.cache_max_size)
 
     def get_original_environment(self):
         return self._orig_environ
@@ -257,10 +272,17 @@ class Config:
         if hasattr(options, 'skip'):
             for item in options.skip:
                 self.skip += item.split(',')
+        if hasattr(options, 'tags'):
+            for item in options.tags:
+                self.tags += item.split(',')
         if hasattr(options, 'force_policy') and options.force_policy:
             self.build_policy = 'all'
         if hasattr(options, 'arch'):
             self.arch = options.arch
+        if hasattr(options, 'resume'):
+            self.resume = options.resume
+        if getattr(options, 'parallel_modules', None):
+            self.max_concurrent_modules = options.parallel_modules
 
         self.__dict__[k] = v
 
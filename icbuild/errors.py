@@ -52,6 +52,9 @@ class DependencyCycleError(IcbuildException):
 class UndefinedRepositoryError(FatalError):
     '''There is a module depending on an undefined repository'''
 
+class IncludeCycleError(FatalError):
+    '''There is a cycle in the includes of the module set'''
+
 class SkipToPhase(Exception):
     def __init__(self, phase):
         Exception.__init__(self)
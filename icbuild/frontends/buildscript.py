@@ -22,8 +22,17 @@ import os
 import logging
 import subprocess
 import sys
+import tarfile
+import time
+import threading
+import concurrent.futures
 
 from icbuild.utils import cmds
+from icbuild.utils.jobserver import JobServer
+from icbuild.utils.buildhistory import BuildHistory
+from icbuild.utils.artifactcache import ArtifactCache
+from icbuild.utils.buildjournal import BuildJournal
+from icbuild.utils.prefixsnapshot import PrefixSnapshot
 from icbuild.errors import FatalError, CommandError, SkipToPhase, SkipToEnd
 
 class BuildScript:
@@ -34,9 +43,34 @@ class BuildScript:
         self.modulelist = module_list
         self.moduleset = module_set
         self.module_num = 0
+        # position in the module list of the module each thread builds
+        self._current = threading.local()
+        self._module_numbers = {}
+        self._error_lock = threading.Lock()
+        self._prefetches = {}
+        self._prefetch_executor = None
+        self.jobserver = None
 
         self.config = config
-
+        self.history = BuildHistory(os.path.join(self.config.top_builddir, 'history'))
+        self.journal = BuildJournal()
+        if self.config.artifact_cache:
+            self.artifacts = ArtifactCache(self.config.artifact_cache)
+        else:
+            self.artifacts = None
+        self._phase_starts = {}
+        self._module_estimates = {}
+        self._module_starts = {}
+        # number of modules started, to tell whether a module was built
+        # alone; guarded by _starts_lock with _module_starts
+        self._modules_started = 0
+        self._starts_lock = threading.Lock()
+        self._modules_done = set()
+        self._prepare_directories()
+
+    def _prepare_directories(self):
+        '''check that the install prefix is writable, and create the
+        checkout directories'''
         # the existence of self.config.prefix is checked in config.py
         if not os.access(self.config.prefix, os.R_OK|os.W_OK|os.X_OK):
             raise FatalError('install prefix (%s) must be writable' % self.config.prefix)
@@ -70,133 +104,363 @@ class BuildScript:
         '''
         raise NotImplementedError
 
-    def build(self, phases=None):
-        '''start the build of the current configuration'''
+    def build(self, phases=None, journal=False):
+        '''start the build of the current configuration; with journal, its
+        progress is recorded for "icbuild build --resume"'''
+        if journal:
+            self.journal = BuildJournal(os.path.join(self.config.top_builddir, 'journal'))
         self.start_build()
-        
+
         failures = [] # list of modules that couldn't be built
-        successes = []
         self.module_num = 0
-        for module in self.modulelist:
-            self.module_num = self.module_num + 1
-
-            if self.config.min_age is not None:
-                installdate = self.moduleset.packagedb.installdate(module.name)
-                if installdate > self.config.min_age:
-                    self.message('Skipping %s (installed recently)' % module.name)
-                    continue
+        self._estimate_modules(phases)
+        self._start_journal()
+        try:
+            if self.config.max_concurrent_modules > 1:
+                # share config.jobs between the makes of all the modules
+                # being built, rather than letting each use -j jobs
+                if self.config.jobs > 1:
+                    self.jobserver = JobServer(self.config.jobs)
+                self._build_parallel(phases, failures)
+            else:
+                for i, module in enumerate(self.modulelist):
+                    self.module_num = self.module_num + 1
+                    self._start_prefetch(self.modulelist[i+1:])
+                    self._build_module(module, phases, failures,
+                                       self.module_num)
+        finally:
+            if self._prefetch_executor:
+                self._prefetch_executor.shutdown(wait=True)
+                self._prefetch_executor = None
+            if self.jobserver:
+                self.jobserver.close()
+                self.jobserver = None
 
-            self.start_module(module.name)
-            failed = False
-            for dep in module.dependencies:
-                if dep in failures:
-                    if self.config.module_nopoison.get(dep,
-                                                       self.config.nopoison):
-                        self.message('module %(mod)s will be built even though %(dep)s failed'
-                                     % { 'mod':module.name, 'dep':dep })
-                    else:
-                        self.message('module %(mod)s not built due to non buildable %(dep)s'
-                                     % { 'mod':module.name, 'dep':dep })
-                        failed = True
-            if failed:
-                failures.append(module.name)
-                self.end_module(module.name, failed)
-                continue
+        self.end_build(failures)
+        if self.config.cache_max_size is not None:
+            self._collect_cache()
+        if failures:
+            return 1
+        self.journal.finish()
+        return 0
 
-            if not phases:
-                build_phases = self.get_build_phases(module)
-            else:
-                build_phases = phases
-            phase = None
-            num_phase = 0
-
-            # if there is an error and a new phase is selected (be it by the
-            # user or an automatic system), the chosen phase must absolutely
-            # be executed, it should in no condition be skipped automatically.
-            # The force_phase variable flags that condition.
-            force_phase = False
-
-            while num_phase < len(build_phases):
-                last_phase, phase = phase, build_phases[num_phase]
-                try:
-                    if not force_phase and module.skip_phase(self, phase, last_phase):
-                        num_phase += 1
+    def _collect_cache(self):
+        '''remove the least recently used downloads if they take more
+        than cache_max_size'''
+        from icbuild.utils import cachegc
+        try:
+            removed = cachegc.collect(self.config, self.moduleset)
+        except (EnvironmentError, FatalError) as e:
+            logging.warning('could not clean the download cache: %s' % e)
+            return
+        if removed:
+            logging.info('removed %d files from the download cache, freeing %s'
+                         % (len(removed), cachegc.format_size(
+                                sum([size for path, size in removed]))))
+
+    def _start_journal(self):
+        '''start journaling the build, or pick up the journal of an
+        interrupted build when resuming'''
+        module_names = [module.name for module in self.modulelist]
+        if getattr(self.config, 'resume', False):
+            if not self.journal.load():
+                logging.info('no interrupted build to resume, building everything')
+            elif self.journal.modules != module_names:
+                logging.warning('the module list changed since the interrupted build')
+            if self.journal.modules is not None:
+                return
+        self.journal.start(module_names)
+
+    def _build_parallel(self, phases, failures):
+        '''build the module list with up to max_concurrent_modules
+        modules running at once.
+
+        A module is started as soon as every module it depends on (hard
+        dependencies, suggests and afters) that comes before it in the
+        module list has finished.  Only earlier modules are waited on, so
+        the order produced by the dependency resolver (which has already
+        broken any cycles) is always a valid schedule.
+
+        When several modules are ready, the one heading the longest chain
+        of work still to do goes first, so that long dependency chains do
+        not leave cores idle at the end of the build.'''
+        max_jobs = self.config.max_concurrent_modules
+        waiting_on = self._get_waiting_on()
+        critical_paths = self._get_critical_paths(waiting_on)
+        pending = list(self.modulelist)
+        # sort is stable, equal paths keep the resolved order
+        pending.sort(key=lambda module: -critical_paths[module.name])
+        running = {}
+        # futures of the running modules that hold a jobserver token
+        with_token = set()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        try:
+            while pending or running:
+                for module in pending[:]:
+                    if len(running) >= max_jobs:
+                        break
+                    if waiting_on[module.name]:
                         continue
-                except SkipToEnd:
-                    break
+                    # one module uses the implicit job slot of its make,
+                    # every other one needs a token for it, so that all
+                    # the makes together run at most config.jobs jobs
+                    token = (self.jobserver is not None and
+                             len(with_token) < len(running))
+                    if token:
+                        self.jobserver.acquire()
+                    pending.remove(module)
+                    self.module_num = self.module_num + 1
+                    future = executor.submit(self._build_module, module,
+                                             phases, failures,
+                                             self.module_num)
+                    if token:
+                        with_token.add(future)
+                        # given back by the worker thread, as this one
+                        # may be waiting for a token
+                        future.add_done_callback(
+                                lambda future, jobserver=self.jobserver:
+                                    jobserver.release())
+                    running[future] = module
+                self._start_prefetch(pending)
+
+                done, not_done = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    module = running.pop(future)
+                    with_token.discard(future)
+                    # propagate exceptions (e.g. SystemExit on exit_on_error)
+                    future.result()
+                    for other in pending:
+                        waiting_on[other.name].discard(module.name)
+        finally:
+            executor.shutdown(wait=True)
+
+    def _get_waiting_on(self):
+        '''return, for each module, the set of modules that have to be
+        built before it can start'''
+        position = dict((module.name, i) for i, module in enumerate(self.modulelist))
+        waiting_on = {}
+        for i, module in enumerate(self.modulelist):
+            waiting_on[module.name] = set(
+                    [dep for dep in module.dependencies + module.suggests + module.after
+                     if position.get(dep, i) < i])
+        return waiting_on
+
+    def _get_critical_paths(self, waiting_on, costs=None):
+        '''return, for each module, the estimated duration of the longest
+        chain of modules that can only start after it, itself included.
+        Durations are taken from costs, or else from the build history;
+        without history every module counts the same.'''
+        if costs is None:
+            costs = self._module_estimates
+        dependents = dict((module.name, []) for module in self.modulelist)
+        for name, deps in waiting_on.items():
+            for dep in deps:
+                dependents[dep].append(name)
+        paths = {}
+        # dependents always come later in the module list
+        for module in reversed(self.modulelist):
+            cost = costs.get(module.name, 1.0)
+            paths[module.name] = cost + max(
+                    [paths[name] for name in dependents[module.name]] or [0])
+        return paths
+
+    def _build_module(self, module, phases, failures, module_num=0):
+        '''build a single module, appending its name to failures if it
+        could not be built; module_num is its number in the messages'''
+        with self._starts_lock:
+            self._module_starts[module.name] = time.time()
+            self._modules_started += 1
+        self._module_numbers[module.name] = module_num
+        self._current.module_num = module_num
+        try:
+            self._run_module(module, phases, failures)
+            self.journal.module_done(module.name, module.name in failures)
+        finally:
+            with self._starts_lock:
+                del self._module_starts[module.name]
+            self._modules_done.add(module.name)
+            self._current.module_num = 0
+
+    def get_module_num(self, module=None):
+        '''return the number of the module built by the calling thread,
+        or else of module, for the [n/N] of the messages; 0 if unknown'''
+        module_num = getattr(self._current, 'module_num', 0)
+        if not module_num and module is not None:
+            module_num = self._module_numbers.get(getattr(module, 'name', None), 0)
+        return module_num
+
+    def _run_module(self, module, phases, failures):
+        if module.name in self.journal.built:
+            self.message('Skipping %s (built before the interruption)' % module.name)
+            return
+
+        if self.config.min_age is not None:
+            installdate = self.moduleset.packagedb.installdate(module.name)
+            if installdate > self.config.min_age:
+                self.message('Skipping %s (installed recently)' % module.name)
+                return
+
+        self._wait_for_prefetch(module)
+        self.start_module(module.name)
+        failed = False
+        for dep in module.dependencies:
+            if dep in failures:
+                if self.config.module_nopoison.get(dep,
+                                                   self.config.nopoison):
+                    self.message('module %(mod)s will be built even though %(dep)s failed'
+                                 % { 'mod':module.name, 'dep':dep })
+                else:
+                    self.message('module %(mod)s not built due to non buildable %(dep)s'
+                                 % { 'mod':module.name, 'dep':dep })
+                    failed = True
+        if failed:
+            failures.append(module.name)
+            self.end_module(module.name, failed)
+            return
 
-                if not module.has_phase(phase):
-                    # skip phases that do not exist, this can happen when
-                    # phases were explicitely passed to this method.
+        if not phases:
+            build_phases = self.get_build_phases(module)
+        else:
+            # copied, as error handling may insert phases into the list
+            build_phases = phases[:]
+        # phases completed before an interruption
+        resumed = [phase for phase in build_phases
+                   if phase in self.journal.phases.get(module.name, ())]
+        build_phases = [phase for phase in build_phases if phase not in resumed]
+
+        if self._restore_artifact(module, build_phases):
+            self.end_module(module.name, failed)
+            return
+
+        snapshot = None
+        if ('install' in build_phases and not resumed and
+                not module.supports_install_destdir):
+            snapshot = self._take_snapshot()
+
+        phase = None
+        num_phase = 0
+
+        # if there is an error and a new phase is selected (be it by the
+        # user or an automatic system), the chosen phase must absolutely
+        # be executed, it should in no condition be skipped automatically.
+        # The force_phase variable flags that condition.
+        force_phase = False
+
+        while num_phase < len(build_phases):
+            last_phase, phase = phase, build_phases[num_phase]
+            try:
+                if not force_phase and module.skip_phase(self, phase, last_phase):
                     num_phase += 1
                     continue
+            except SkipToEnd:
+                break
+
+            if not module.has_phase(phase):
+                # skip phases that do not exist, this can happen when
+                # phases were explicitely passed to this method.
+                num_phase += 1
+                continue
 
-                self.start_phase(module.name, phase)
-                error = None
+            self._start_phase_internal(module, phase)
+            error = None
+            try:
                 try:
+                    error, altphases = module.run_phase(self, phase)
+                except SkipToPhase as e:
                     try:
-                        error, altphases = module.run_phase(self, phase)
-                    except SkipToPhase as e:
-                        try:
-                            num_phase = build_phases.index(e.phase)
-                        except ValueError:
-                            break
-                        continue
-                    except SkipToEnd:
+                        num_phase = build_phases.index(e.phase)
+                    except ValueError:
                         break
-                finally:
-                    self._end_phase_internal(module.name, phase, error)
-
-                if error:
-                    if self.config.exit_on_error:
-                        sys.exit(1)
+                    continue
+                except SkipToEnd:
+                    break
+            finally:
+                start, duration = self._end_phase_internal(module, phase, error)
+            # not reached by phases skipped or interrupted
+            self._phase_completed(module, phase, start, duration, error)
+            if (phase == 'install' and not error and
+                    not module.supports_install_destdir):
+                module.record_install(self, self._get_installed(snapshot))
+
+            if error:
+                if self.config.exit_on_error:
+                    sys.exit(1)
 
-                    try:
-                        nextphase = build_phases[num_phase+1]
-                    except IndexError:
-                        nextphase = None
+                try:
+                    nextphase = build_phases[num_phase+1]
+                except IndexError:
+                    nextphase = None
+                # only one module at a time gets to ask the user
+                with self._error_lock:
                     newphase = self.handle_error(module, phase,
                                                  nextphase, error,
                                                  altphases)
-                    force_phase = True
-                    if newphase == 'fail':
-                        failures.append(module.name)
-                        failed = True
-                        break
-                    if newphase is None:
-                        break
-                    if newphase in build_phases:
-                        num_phase = build_phases.index(newphase)
-                    else:
-                        # requested phase is not part of the plan, we insert
-                        # it, then fill with necessary phases to get back to
-                        # the current one.
-                        filling_phases = self.get_build_phases(module, targets=[phase])
-                        canonical_new_phase = newphase
-                        if canonical_new_phase.startswith('force_'):
-                            # the force_ phases won't appear in normal build
-                            # phases, so get the non-forced phase
-                            canonical_new_phase = canonical_new_phase[6:]
-
-                        if canonical_new_phase in filling_phases:
-                            filling_phases = filling_phases[
-                                    filling_phases.index(canonical_new_phase)+1:-1]
-                        build_phases[num_phase:num_phase] = [newphase] + filling_phases
-
-                        if build_phases[num_phase+1] == canonical_new_phase:
-                            # remove next phase if it would just be a repeat of
-                            # the inserted one
-                            del build_phases[num_phase+1]
+                force_phase = True
+                if newphase == 'fail':
+                    failures.append(module.name)
+                    failed = True
+                    break
+                if newphase is None:
+                    break
+                if newphase in build_phases:
+                    num_phase = build_phases.index(newphase)
                 else:
-                    force_phase = False
-                    num_phase += 1
-
-            self.end_module(module.name, failed)
-
-        self.end_build(failures)
-        if failures:
-            return 1
-        return 0
+                    # requested phase is not part of the plan, we insert
+                    # it, then fill with necessary phases to get back to
+                    # the current one.
+                    filling_phases = self.get_build_phases(module, targets=[phase])
+                    canonical_new_phase = newphase
+                    if canonical_new_phase.startswith('force_'):
+                        # the force_ phases won't appear in normal build
+                        # phases, so get the non-forced phase
+                        canonical_new_phase = canonical_new_phase[6:]
+
+                    if canonical_new_phase in filling_phases:
+                        filling_phases = filling_phases[
+                                filling_phases.index(canonical_new_phase)+1:-1]
+                    build_phases[num_phase:num_phase] = [newphase] + filling_phases
+
+                    if build_phases[num_phase+1] == canonical_new_phase:
+                        # remove next phase if it would just be a repeat of
+                        # the inserted one
+                        del build_phases[num_phase+1]
+            else:
+                force_phase = False
+                num_phase += 1
+
+        self.end_module(module.name, failed)
+
+    def _start_prefetch(self, modules):
+        '''fetch and unpack the sources of the first prefetch_checkouts
+        modules in the given list in the background, while the current
+        modules are being built'''
+        if self.config.prefetch_checkouts < 1:
+            return
+        if self._prefetch_executor is None:
+            self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config.prefetch_checkouts)
+        for module in modules[:self.config.prefetch_checkouts]:
+            if module.name in self._prefetches:
+                continue
+            if not hasattr(module, 'prefetch'):
+                continue
+            if not 'checkout' in self.get_build_phases(module):
+                continue
+            self._prefetches[module.name] = self._prefetch_executor.submit(
+                    module.prefetch, self)
+
+    def _wait_for_prefetch(self, module):
+        '''wait for a background prefetch of module to be over, if any'''
+        future = self._prefetches.pop(module.name, None)
+        if future is None:
+            return
+        try:
+            future.result()
+        except Exception as e:
+            # the checkout phase will try again and report the error
+            logging.info('prefetching %(module)s failed: %(error)s' %
+                         {'module': module.name, 'error': e})
 
     def get_build_phases(self, module, targets=None):
         '''returns the list of required phases'''
@@ -253,8 +517,115 @@ class BuildScript:
         The argument is a string containing the error text if something
         went wrong.'''
         pass
+    def _may_restore_artifact(self, build_phases):
+        '''whether modules built with build_phases may be installed from
+        the artifact cache; --force and --clean ask for a real build'''
+        return bool(self.artifacts and 'install' in build_phases and
+                    not 'clean' in build_phases and
+                    self.config.build_policy != 'all')
+
+    def _restore_artifact(self, module, build_phases):
+        '''install module from the artifact cache if it holds a build of
+        the same inputs; returns True if it did'''
+        if not self._may_restore_artifact(build_phases):
+            return False
+        try:
+            return module.restore_artifact(self)
+        except (CommandError, EnvironmentError, tarfile.TarError) as e:
+            logging.warning('Could not restore %(module)s from the artifact cache: %(msg)s'
+                            % {'module': module.name, 'msg': e})
+            return False
+
+    def _take_snapshot(self):
+        '''return a snapshot of the prefix, with the number of modules
+        started so far, to find the files the module being built installs
+        into it; None when other modules are being built'''
+        config = self.config
+        exclude = [config.top_builddir, config.checkoutroot, config.buildroot,
+                   config.copy_dir, getattr(config, 'tarballdir', None)]
+        with self._starts_lock:
+            if len(self._module_starts) > 1:
+                return None
+            started = self._modules_started
+        return PrefixSnapshot(config.prefix, [path for path in exclude if path]), started
+
+    def _get_installed(self, snapshot):
+        '''return the files written into the prefix since snapshot, or
+        None if they are not known, as other modules were built meanwhile'''
+        if snapshot is None:
+            return None
+        snapshot, started = snapshot
+        with self._starts_lock:
+            if self._modules_started != started:
+                return None
+        return snapshot.get_changes()
+
+    def _start_phase_internal(self, module, phase):
+        self._phase_starts[(module.name, phase)] = time.time()
+        self.start_phase(module.name, phase)
     def _end_phase_internal(self, module, phase, error):
-        self.end_phase(module, phase, error)
+        start = self._phase_starts.pop((module.name, phase))
+        duration = time.time() - start
+        self.end_phase(module.name, phase, error)
+        return start, duration
+    def _phase_completed(self, module, phase, start, duration, error):
+        # a phase cut short would drag the estimates down
+        try:
+            revision = module.get_revision()
+        except Exception:
+            revision = None
+        self.history.add(module.name, phase, start, duration,
+                         error is None, revision)
+        if error is None:
+            self.journal.phase_done(module.name, phase)
+
+    def _estimate_modules(self, phases=None):
+        '''look up the expected duration of each module of the build in
+        the build history; modules that never ran are expected to take
+        the average time of those that did.'''
+        estimates = {}
+        for module in self.modulelist:
+            estimates[module.name] = self.history.estimate_module(
+                    module.name, phases or self.get_build_phases(module))
+        known = [x for x in estimates.values() if x is not None]
+        if known:
+            average = sum(known) / len(known)
+            for name, estimate in estimates.items():
+                if estimate is None:
+                    estimates[name] = average
+        else:
+            estimates = {}
+        self._module_estimates = estimates
+
+    def _get_work(self):
+        '''return a (done, total) tuple of estimated seconds of work'''
+        total = sum(self._module_estimates.values())
+        done = sum([self._module_estimates[name] for name in self._modules_done])
+        now = time.time()
+        for name, start in list(self._module_starts.items()):
+            # a module running late is still not done
+            done += min(now - start, 0.95 * self._module_estimates[name])
+        return done, total
+
+    def get_progress(self):
+        '''Return the fraction of the build done according to the build
+        history, or None if there is no history to go on.'''
+        if not self._module_estimates:
+            return None
+        done, total = self._get_work()
+        if not total:
+            return None
+        return min(done / total, 1.0)
+
+    def get_remaining_time(self):
+        '''Return the estimated number of seconds until the end of the
+        build, or None if there is no history to go on.'''
+        if not self._module_estimates:
+            return None
+        done, total = self._get_work()
+        concurrency = min(self.config.max_concurrent_modules,
+                          max(len(self.modulelist) - len(self._modules_done), 1))
+        return max(total - done, 0) / concurrency
 
     def message(self, msg, module_num=-1):
         '''Display a message to the user'''
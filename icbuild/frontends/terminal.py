@@ -41,17 +41,19 @@ except: pass
 
 
 class TerminalBuildScript(buildscript.BuildScript):
-    triedcheckout = None
     is_end_of_build = False
 
     def __init__(self, config, module_list, module_set=None):
         buildscript.BuildScript.__init__(self, config, module_list, module_set=module_set)
+        # automatic recovery step reached by each module, as modules
+        # may fail at the same time in parallel builds
+        self.triedcheckout = {}
         
     def message(self, msg, module_num=-1):
         '''Display a message to the user'''
         
         if module_num == -1:
-            module_num = self.module_num
+            module_num = self.get_module_num()
         if module_num > 0:
             progress = ' [%d/%d]' % (module_num, len(self.modulelist))
         else:
@@ -60,12 +62,14 @@ class TerminalBuildScript(buildscript.BuildScript):
         if not self.config.progress_bar:
             uprint('%s*** %s ***%s%s' % (t_bold, msg, progress, t_reset))
         else:
-            progress_percent = 1.0 * (module_num-1) / len(self.modulelist)
+            progress_percent = self.get_progress()
+            if progress_percent is None:
+                progress_percent = 1.0 * max(module_num-1, 0) / len(self.modulelist)
             self.display_status_line(progress_percent, module_num, msg)
 
     def set_action(self, action, module, module_num=-1, action_target=None):
         if module_num == -1:
-            module_num = self.module_num
+            module_num = self.get_module_num(module)
         if not action_target:
             action_target = module.name
         self.message('%s %s' % (action, action_target), module_num)
@@ -83,6 +87,9 @@ class TerminalBuildScript(buildscript.BuildScript):
         module_no_digits = len(str(len(self.modulelist)))
         format_str = '%%%dd' % module_no_digits
         module_pos = '[' + format_str % module_num + '/' + format_str % len(self.modulelist) + ']'
+        remaining = self.get_remaining_time()
+        if remaining is not None and not self.is_end_of_build:
+            module_pos += ' ETA %d:%02d' % (remaining // 60, remaining % 60)
 
         output = '%s %s %s%s%s' % (progress_bar, module_pos, t_bold, message, t_reset)
         text_width = len(output) - (len(t_bold) + len(t_reset))
@@ -132,6 +139,10 @@ class TerminalBuildScript(buildscript.BuildScript):
         kws['stdout'] = None
         kws['stderr'] = None
 
+        if self.jobserver and self.jobserver.pass_fds:
+            # the jobserver pipe has to be inherited by make
+            kws['pass_fds'] = self.jobserver.pass_fds
+
         if cwd is not None:
             kws['cwd'] = cwd
 
@@ -165,7 +176,7 @@ class TerminalBuildScript(buildscript.BuildScript):
                                % print_args['command'])
 
     def start_module(self, module):
-        self.triedcheckout = None
+        self.triedcheckout.pop(module, None)
 
     def end_build(self, failures):
         self.is_end_of_build = True
@@ -189,15 +200,16 @@ class TerminalBuildScript(buildscript.BuildScript):
             self.message(summary)
 
         if self.config.trycheckout:
-            if self.triedcheckout is None and altphases.count('configure'):
-                self.triedcheckout = 'configure'
+            triedcheckout = self.triedcheckout.get(module.name)
+            if triedcheckout is None and altphases.count('configure'):
+                self.triedcheckout[module.name] = 'configure'
                 self.message('automatically retrying configure')
                 return 'configure'
-            elif self.triedcheckout == 'configure' and altphases.count('force_checkout'):
-                self.triedcheckout = 'done'
+            elif triedcheckout == 'configure' and altphases.count('force_checkout'):
+                self.triedcheckout[module.name] = 'done'
                 self.message('automatically forcing a fresh checkout')
                 return 'force_checkout'
-        self.triedcheckout = None
+        self.triedcheckout.pop(module.name, None)
 
         if not self.config.interact:
             return 'fail'
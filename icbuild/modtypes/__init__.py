@@ -31,11 +31,18 @@ import os
 import re
 import shutil
 import logging
+import tarfile
+import threading
+try:
+    import hashlib
+except ImportError:
+    import md5 as hashlib
 
 from icbuild.errors import FatalError, CommandError, BuildStateError, \
              SkipToEnd, UndefinedRepositoryError
 from icbuild.utils.sxml import sxml
 import icbuild.utils.fileutils as fileutils
+from icbuild.utils import lockfile
 
 _module_types = {}
 def register_module_type(name, parse_func):
@@ -165,6 +172,9 @@ def get_branch(node, repositories, default_repo, config):
     return repo.branch_from_xml(name, childnode, repositories, default_repo)
 
 
+# guards Package.get_input_hash(), modules may be built from several threads
+_input_hash_lock = threading.RLock()
+
 class Package:
     type = 'base'
     PHASE_START = 'start'
@@ -297,11 +307,14 @@ them into the prefix."""
                 errors.append(str(e))
         return num_copied
 
-    def process_install(self, buildscript, revision):
-        assert self.supports_install_destdir
+    def process_install(self, buildscript, revision, from_artifact=False):
+        # modules installing into the prefix come here when restored
+        assert self.supports_install_destdir or from_artifact
         destdir = self.get_destdir(buildscript)
-        self._clean_la_files(buildscript, destdir)
-        self._clean_texinfo_dir_files(buildscript, destdir)
+        if not from_artifact:
+            # artifacts hold the files as they were installed
+            self._clean_la_files(buildscript, destdir)
+            self._clean_texinfo_dir_files(buildscript, destdir)
 
         prefix_without_drive = os.path.splitdrive(buildscript.config.prefix)[1]
         stripped_prefix = prefix_without_drive[1:]
@@ -311,7 +324,22 @@ them into the prefix."""
         broken_name = destdir + '-broken'
         destdir_prefix = os.path.join(destdir, stripped_prefix)
         new_contents = fileutils.accumulate_dirtree_contents(destdir_prefix)
+        content_hash = None
+        if os.path.isdir(destdir_prefix):
+            content_hash = fileutils.hash_dirtree_contents(destdir_prefix,
+                                                           new_contents)
         errors = []
+        input_hash = None
+        # only the artifact cache and the hashed build policy need it
+        if buildscript.artifacts or buildscript.config.build_policy == 'hashed':
+            input_hash = self.get_input_hash(buildscript)
+        if (buildscript.artifacts and input_hash and not from_artifact
+                and os.path.isdir(destdir_prefix)):
+            try:
+                buildscript.artifacts.store(input_hash, destdir)
+            except (EnvironmentError, tarfile.TarError) as e:
+                logging.warning('Could not store %(module)s in the artifact cache: %(msg)s'
+                                % {'module': self.name, 'msg': e})
         if os.path.isdir(destdir_prefix):
             destdir_install = True
             logging.info('Moving temporary DESTDIR %r into build prefix' % (destdir, ))
@@ -323,7 +351,7 @@ them into the prefix."""
             # $JHBUILD_PREFIX/_icbuild/root-foo/$JHBUILD_PREFIX
             # Remove them one by one to clean the tree to the state we expect,
             # so we can better spot leftovers or broken things.
-            prefix_dirs = filter(lambda x: x != '', stripped_prefix.split(os.sep))
+            prefix_dirs = [x for x in stripped_prefix.split(os.sep) if x != '']
             while len(prefix_dirs) > 0:
                 dirname = prefix_dirs.pop()
                 subprefix = os.path.join(*([destdir] + prefix_dirs))
@@ -383,7 +411,9 @@ them into the prefix."""
 
             buildscript.moduleset.packagedb.add(self.name, revision or '',
                                                 new_contents,
-                                                self.configure_cmd)
+                                                self.configure_cmd,
+                                                input_hash,
+                                                content_hash)
 
         if errors:
             raise CommandError('Install encountered errors: %(num)d '
@@ -396,6 +426,134 @@ them into the prefix."""
             logging.info('Install complete: %d files copied' %
                          (num_copied, ))
 
+    def restore_artifact(self, buildscript):
+        """Install this module from the artifact cache, without building
+        it.  Returns True if it was restored."""
+        if not buildscript.artifacts:
+            return False
+        input_hash = self.get_input_hash(buildscript)
+        if not input_hash or not buildscript.artifacts.has(input_hash):
+            return False
+        entry = buildscript.moduleset.packagedb.get(self.name)
+        if entry and entry.metadata.get('input-hash') == input_hash:
+            # already installed, the build policy decides what to do
+            return False
+        buildscript.set_action('Restoring from artifact cache', self)
+        # laid out as a DESTDIR, whether the module supports one or not
+        destdir = self.get_destdir(buildscript)
+        if os.path.exists(destdir):
+            shutil.rmtree(destdir)
+        os.makedirs(destdir)
+        buildscript.artifacts.restore(input_hash, destdir)
+        self.process_install(buildscript, self.get_revision(), from_artifact=True)
+        return True
+
+    def record_install(self, buildscript, changes=None):
+        """Record in the package database that the install phase of this
+        module went through.  Modules installing into a DESTDIR are
+        recorded by process_install(), the build script calls this for
+        the other ones, which install straight into the prefix.
+
+        changes lists the files the build wrote into the prefix, relative
+        to it, when they are known.  With the files of the previous install
+        still there, left alone by installs that skip up to date files,
+        they make the manifest, the content hash that keeps modules
+        depending on this one from being rebuilt when it did not change,
+        and the artifact stored in the artifact cache."""
+        prefix = buildscript.config.prefix
+        contents = None
+        content_hash = None
+        if changes is not None:
+            contents = set(changes)
+            previous_entry = buildscript.moduleset.packagedb.get(self.name)
+            if previous_entry and previous_entry.manifest:
+                for filename in previous_entry.manifest:
+                    path = os.path.join(prefix, filename)
+                    if filename and os.path.lexists(path) and (
+                            filename.endswith(os.sep) or os.path.islink(path)
+                            or not os.path.isdir(path)):
+                        contents.add(filename)
+            contents = sorted(contents)
+        # with nothing found, the files may have gone outside of the
+        # prefix: do not claim they did not change
+        if contents:
+            try:
+                content_hash = fileutils.hash_dirtree_contents(prefix, contents)
+            except EnvironmentError as e:
+                logging.warning('could not hash the files of %(module)s: %(msg)s'
+                                % {'module': self.name, 'msg': e})
+        input_hash = None
+        # only the artifact cache and the hashed build policy need it
+        if buildscript.artifacts or buildscript.config.build_policy == 'hashed':
+            input_hash = self.get_input_hash(buildscript)
+        if buildscript.artifacts and input_hash and contents:
+            # stored as a DESTDIR would hold them, see process_install()
+            drive, prefix_without_drive = os.path.splitdrive(prefix)
+            stripped_prefix = prefix_without_drive[1:]
+            try:
+                buildscript.artifacts.store(input_hash, drive + os.sep,
+                        [os.path.join(stripped_prefix, x) for x in contents])
+            except (EnvironmentError, tarfile.TarError) as e:
+                logging.warning('Could not store %(module)s in the artifact cache: %(msg)s'
+                                % {'module': self.name, 'msg': e})
+        buildscript.moduleset.packagedb.add(self.name, self.get_revision() or '',
+                                            contents, self.configure_cmd,
+                                            input_hash, content_hash)
+
+    def get_build_inputs(self, buildscript):
+        """Return a list of strings describing what goes into building
+        this module, apart from its dependencies.  Subclasses add their
+        build arguments."""
+        config = buildscript.config
+        inputs = [self.type, self.name, config.prefix,
+                  getattr(config, 'arch', ''), self.get_revision() or '',
+                  self.configure_cmd or '']
+        inputs.extend(self.branch.get_build_inputs(buildscript))
+        extra_env = self.extra_env or {}
+        for key in sorted(extra_env.keys()):
+            inputs.append('%s=%s' % (key, extra_env[key]))
+        return inputs
+
+    _input_hash = None
+    _hashing_inputs = False
+    def get_input_hash(self, buildscript):
+        """Return a hash of the build inputs of this module and of the
+        input hashes of its dependencies, or None if it cannot be known
+        (e.g. the branch type has no tree_id()).  It is used as the key
+        in the artifact cache."""
+        with _input_hash_lock:
+            if self._input_hash is None:
+                self._hashing_inputs = True
+                try:
+                    self._input_hash = self._compute_input_hash(buildscript) or ''
+                finally:
+                    self._hashing_inputs = False
+        return self._input_hash or None
+
+    def _compute_input_hash(self, buildscript):
+        try:
+            inputs = self.get_build_inputs(buildscript)
+        except (NotImplementedError, AttributeError, CommandError,
+                BuildStateError, EnvironmentError):
+            return None
+        for dep in self.dependencies:
+            try:
+                dep_module = buildscript.moduleset.get_module(dep)
+            except KeyError:
+                # not part of the moduleset, e.g. a system dependency
+                continue
+            if dep_module._hashing_inputs:
+                # circular dependency
+                continue
+            dep_hash = dep_module.get_input_hash(buildscript)
+            if dep_hash is None:
+                return None
+            inputs.append('%s:%s' % (dep, dep_hash))
+        sha = hashlib.sha256()
+        for item in inputs:
+            sha.update(item.encode('utf-8') + b'\0')
+        return sha.hexdigest()
+
     def get_revision(self):
         return self.branch.tree_id()
 
@@ -427,7 +585,8 @@ them into the prefix."""
         return hasattr(self, 'do_' + phase)
 
     def check_build_policy(self, buildscript):
-        if not buildscript.config.build_policy in ('updated', 'updated-deps'):
+        if not buildscript.config.build_policy in ('updated', 'updated-deps',
+                                                   'hashed'):
             return
 
         # Always trigger a build for dirty branches if supported by the version
@@ -435,6 +594,16 @@ them into the prefix."""
         if hasattr(self.branch, 'is_dirty') and self.branch.is_dirty():
             return
 
+        if buildscript.config.build_policy == 'hashed':
+            input_hash = self.get_input_hash(buildscript)
+            entry = buildscript.moduleset.packagedb.get(self.name)
+            if (input_hash and entry is not None and
+                    entry.metadata.get('input-hash') == input_hash):
+                buildscript.message(
+                        'Skipping %s (build inputs not changed)' % self.name)
+                return self.PHASE_DONE
+            return None
+
         if not buildscript.moduleset.packagedb.check(self.name, self.get_revision() or ''):
             # package has not been updated
             return
@@ -447,8 +616,10 @@ them into the prefix."""
         if buildscript.config.build_policy == 'updated-deps':
             install_date = buildscript.moduleset.packagedb.installdate(self.name)
             for dep in self.dependencies:
-                install_date_dep = buildscript.moduleset.packagedb.installdate(dep)
-                if install_date_dep > install_date:
+                # a dependency reinstalled with identical files does not
+                # count as updated
+                changed_date_dep = buildscript.moduleset.packagedb.changedate(dep)
+                if changed_date_dep > install_date:
                     # a dependency has been updated
                     return None
             else:
@@ -494,6 +665,26 @@ them into the prefix."""
         """Serialize this module's checkout branch as sxml."""
         return self.branch.to_sxml()
 
+    def to_lock(self):
+        """Serialize this module, with its branch, as a dictionary of
+        JSON values for a lock file."""
+        data = lockfile.export_attrs(self, ('config', 'branch'))
+        if self.branch is not None:
+            data['branch'] = self.branch.to_lock()
+        return data
+
+    @classmethod
+    def from_lock(cls, config, data):
+        """Create a module from the output of to_lock()."""
+        instance = cls.__new__(cls)
+        lockfile.import_attrs(instance, data, ('branch',))
+        instance.config = config
+        instance.branch = None
+        if data.get('branch'):
+            branch_class = lockfile.get_class(data['branch']['class'])
+            instance.branch = branch_class.from_lock(config, data['branch'])
+        return instance
+
     @classmethod
     def parse_from_xml(cls, node, config, uri, repositories, default_repo):
         """Create a new Package instance from a DOM XML node."""
@@ -527,13 +718,19 @@ class MakeModule(Package):
                                   self.name, self.config.makeargs))
         if self.supports_parallel_build and add_parallel:
             # Propagate job count into makeargs, unless -j is already set
-            if ' -j' not in makeargs:
+            # or make gets its job slots from the shared jobserver
+            if ' -j' not in makeargs and not buildscript.jobserver:
                 arg = '-j %s' % (buildscript.config.jobs, )
                 makeargs = makeargs + ' ' + arg
         elif not self.supports_parallel_build:
             makeargs = re.sub(r'-j\w*\d+', '', makeargs) + ' -j 1'
         return self.eval_args(makeargs).strip()
 
+    def get_build_inputs(self, buildscript):
+        return Package.get_build_inputs(self, buildscript) + [
+                self.get_makeargs(buildscript, add_parallel=False),
+                self.makeinstallargs, self.makefile]
+
     def get_makecmd(self, config):
         if self.needs_gmake and 'gmake' in config.conditions:
             return 'gmake'
@@ -544,13 +741,19 @@ class MakeModule(Package):
         makecmd = os.environ.get('MAKE', self.get_makecmd(buildscript.config))
 
         if makeargs is None:
-            makeargs = self.get_makeargs(self, buildscript)
+            makeargs = self.get_makeargs(buildscript)
+
+        extra_env = self.extra_env
+        if (buildscript.jobserver and self.supports_parallel_build and
+                ' -j' not in ' ' + makeargs):
+            extra_env = dict(extra_env or {})
+            extra_env['MAKEFLAGS'] = buildscript.jobserver.get_makeflags()
 
         cmd = '{pre}{make} {makeargs} {target}'.format(pre=pre,
                                                         make=makecmd,
                                                         makeargs=makeargs,
                                                         target=target)
-        buildscript.execute(cmd, cwd = self.get_builddir(buildscript), extra_env = self.extra_env)
+        buildscript.execute(cmd, cwd = self.get_builddir(buildscript), extra_env = extra_env)
 
 class DownloadableModule:
     PHASE_CHECKOUT = 'checkout'
@@ -571,6 +774,11 @@ class DownloadableModule:
         if self.check_build_policy(buildscript) == self.PHASE_DONE:
             raise SkipToEnd()
 
+    def prefetch(self, buildscript):
+        '''Get the sources ready ahead of the checkout phase; this is run
+        in a background thread while other modules are being built.'''
+        self.branch.prefetch(buildscript)
+
     def skip_checkout(self, buildscript, last_phase):
         # skip the checkout stage if the nonetwork flag is set
         if not self.branch.may_checkout(buildscript):
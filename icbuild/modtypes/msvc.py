@@ -62,6 +62,10 @@ class MSVCModule(Package, DownloadableModule):
         # do nothing for now
     do_install.depends = [PHASE_BUILD]
 
+    def get_build_inputs(self, buildscript):
+        return Package.get_build_inputs(self, buildscript) + [
+                self.solution, self.msvcargs, buildscript.config.vs_dir]
+
     def xml_tag_and_attrs(self):
         return 'msvc', [('id', 'name', None)]
 
@@ -21,27 +21,35 @@ from __future__ import generators
 
 import os
 import sys
+import time
+import atexit
+import hashlib
+import pickle
+import threading
+import concurrent.futures
 from urllib.parse import urlparse, urljoin
 import logging
 
 from icbuild.errors import UsageError, FatalError, DependencyCycleError, \
-             CommandError, UndefinedRepositoryError
+             CommandError, UndefinedRepositoryError, IncludeCycleError
 
 try:
-    import xml.dom.minidom
     import xml.parsers.expat
 except ImportError:
     raise FatalError('Python XML packages are required but could not be found')
 
 from icbuild import modtypes
+from icbuild import versioncontrol
 from icbuild.versioncontrol import get_repo_type
 from icbuild.utils import httpcache
 from icbuild.utils import packagedb
 from icbuild.utils.cmds import compare_version, get_output
 from icbuild.versioncontrol.tarball import TarballBranch
 from icbuild.utils import fileutils
+from icbuild.utils import lockfile
+from icbuild.utils.depgraph import DependencyGraph
 
-__all__ = ['load', 'load_tests', 'get_default_repo']
+__all__ = ['load', 'load_tests', 'get_default_repo', 'freeze', 'load_lockfile']
 
 virtual_sysdeps = [
     'cmake',
@@ -52,11 +60,52 @@ _default_repo = None
 def get_default_repo():
     return _default_repo
 
+class _ModuleDict(dict):
+    '''Dictionary of the modules of a set, counting the changes made to it
+    so that the indexes built from it can tell when they are out of date.'''
+
+    changes = 0
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changes += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changes += 1
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.changes += 1
+
+    def setdefault(self, key, default=None):
+        self.changes += 1
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self.changes += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.changes += 1
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.changes += 1
+
 class ModuleSet:
     def __init__(self, config = None, db=None):
         self.config = config
-        self.modules = {}
+        self.modules = _ModuleDict()
         self.raise_exception_on_warning=False
+        self._indexed_changes = None
+        self._graph = None
+        self._graph_changes = None
+        # build order recorded in the lock file the set was loaded from
+        self.frozen_build = None
+        # the moduleset files the set was read from, includes too
+        self.uris = []
 
         if db is None:
             legacy_pkgdb_path = os.path.join(self.config.prefix, 'share', 'icbuild', 'packagedb.xml')
@@ -71,18 +120,90 @@ class ModuleSet:
         '''add a Module object to this set of modules'''
         self.modules[module.name] = module
 
+    def _update_indexes(self):
+        '''Rebuild the lookup tables if modules changed since they were
+        last built.'''
+        if self._indexed_changes == self.modules.changes:
+            return
+        self._lower_names = {}
+        self._tagged = {}
+        self._required_by = {}
+        self._before = {}
+        for name, module in self.modules.items():
+            self._lower_names.setdefault(name.lower(), name)
+            for tag in module.tags:
+                self._tagged.setdefault(tag, set()).add(name)
+            for dep in set(module.dependencies):
+                self._required_by.setdefault(dep, []).append(name)
+            for dep in set(module.after):
+                self._before.setdefault(dep, []).append(name)
+        self._indexed_changes = self.modules.changes
+
     def get_module(self, module_name, ignore_case = False):
         module_name = module_name.rstrip(os.sep)
         if module_name in self.modules or not ignore_case:
             return self.modules[module_name]
-        module_name_lower = module_name.lower()
-        for module in self.modules.keys():
-            if module.lower() == module_name_lower:
-                logging.info('fixed case of module \'%(orig)s\' to '
-                             '\'%(new)s\'' % {'orig': module_name,
-                                              'new': module})
-                return self.modules[module]
-        raise KeyError(module_name)
+        self._update_indexes()
+        module = self._lower_names.get(module_name.lower())
+        if module is None:
+            raise KeyError(module_name)
+        logging.info('fixed case of module \'%(orig)s\' to '
+                     '\'%(new)s\'' % {'orig': module_name,
+                                      'new': module})
+        return self.modules[module]
+
+    def get_graph(self):
+        '''Return the DependencyGraph of the modules, for reachability
+        queries.'''
+        if self._graph_changes != self.modules.changes:
+            self._graph = DependencyGraph(list(self.modules.values()))
+            self._graph_changes = self.modules.changes
+        return self._graph
+
+    def _get_edge_kinds(self, include_suggests, include_afters):
+        kinds = ['dependencies']
+        if include_suggests:
+            kinds.append('suggests')
+        if include_afters:
+            kinds.append('after')
+        return kinds
+
+    def get_dependency_closure(self, module_names, include_suggests=False,
+                               include_afters=False):
+        '''Return the names of module_names and of all the modules they
+        depend on, directly or not.'''
+        graph = self.get_graph()
+        return graph.get_names(graph.closure(module_names,
+                self._get_edge_kinds(include_suggests, include_afters)))
+
+    def get_reverse_closure(self, module_names, include_suggests=False,
+                            include_afters=False):
+        '''Return the names of module_names and of all the modules that
+        depend on them, directly or not; that is what has to be rebuilt
+        when they change.'''
+        graph = self.get_graph()
+        return graph.get_names(graph.closure(module_names,
+                self._get_edge_kinds(include_suggests, include_afters),
+                reverse=True))
+
+    def get_tagged_modules(self, tags):
+        '''Return the names of the modules having at least one of tags.'''
+        self._update_indexes()
+        names = set()
+        for tag in tags:
+            names.update(self._tagged.get(tag, ()))
+        return names
+
+    def get_reverse_dependencies(self, module_name):
+        '''Return the names of the modules that depend on module_name.'''
+        self._update_indexes()
+        return list(self._required_by.get(module_name, []))
+
+    def get_reverse_after(self, module_name):
+        '''Return the names of the modules that have to be built after
+        module_name.'''
+        self._update_indexes()
+        return list(self._before.get(module_name, []))
 
     def get_module_list(self, module_names, skip=[], tags=[],
                         include_suggests=True, include_afters=False):
@@ -96,88 +217,138 @@ class ModuleSet:
                                 include_suggests=True, include_afters=False,
                                 warn_about_circular_dependencies=True):
 
-        def dep_resolve(node, resolved, seen, after):
-            ''' Recursive depth-first search of the dependency tree. Creates
-            the build order into the list 'resolved'. <after/> modules are
-            added to the dependency tree but flagged. When search finished
-            <after/> modules not a real dependency are removed.
-            '''
-            circular = False
+        frozen = self.frozen_build
+        if frozen is not None and not include_afters:
+            if not isinstance(module_names, str):
+                module_names = list(module_names)
+            if (module_names == frozen['modules'] and
+                    list(skip) == frozen['skip'] and
+                    include_suggests == frozen['include-suggests']):
+                return [self.modules[name] for name in frozen['order']]
+
+        # build order, and whether each module in it was only reached
+        # through <after/> edges (the value is False once the module is
+        # a real dependency of something)
+        resolved = []
+        after_only = {}
+        # when each module became a real dependency, to tell which ones
+        # already were at the time a node was entered
+        kept_at = {}
+        clock = [0]
+        # current dependency path, as a list for messages and as a set for
+        # membership tests
+        seen = []
+        seen_set = set()
+        skip_set = set(skip)
+
+        def enter(node, after):
             seen.append(node)
+            seen_set.add(node)
             if include_suggests:
                 edges = node.dependencies + node.suggests + node.after
             else:
                 edges = node.dependencies + node.after
-            # do not include <after> modules because a previous visited <after>
-            # module may later be a hard dependency
-            resolved_deps = [module for module, after_module in resolved \
-                             if not after_module]
-            for edge_name in edges:
-                edge = self.modules.get(edge_name)
-                if edge == None:
-                    if node not in [i[0] for i in resolved]:
-                        self._warn('%(module)s has a dependency on unknown'
-                                   ' "%(invalid)s" module' % \
-                                       {'module'  : node.name,
-                                        'invalid' : edge_name})
-                elif edge_name not in skip and edge not in resolved_deps:
-                    if edge in seen:
-                        # circular dependency detected
-                        circular = True
-                        if self.raise_exception_on_warning:
-                            # Translation of string not required - used in
-                            # unit tests only
-                            raise UsageError('Circular dependencies detected')
-                        if warn_about_circular_dependencies:
-                            self._warn('Circular dependencies detected: %s' \
-                                       % ' -> '.join([i.name for i in seen] \
-                                                     + [edge.name]))
-                        break
-                    else:
-                        if edge_name in node.after:
-                            dep_resolve(edge, resolved, seen, True)
+            # node, after, edges, next edge, entered_at, circular, and
+            # the hard dependency being visited
+            return [node, after, edges, 0, clock[0], False, None]
+
+        def dep_resolve(root):
+            ''' Depth-first search of the dependency tree. Creates the
+            build order into the list 'resolved'. <after/> modules are
+            added to the dependency tree but flagged. When search finished
+            <after/> modules not a real dependency are removed.
+
+            The search keeps its own stack of frames rather than
+            recursing, long dependency chains would exceed Python's
+            recursion limit.
+            '''
+            stack = [enter(root, False)]
+            while stack:
+                frame = stack[-1]
+                node, after, edges, pos, entered_at, circular, visited = frame
+                if visited is not None:
+                    # hard dependency may be missed if a cyclic
+                    # dependency. Add it:
+                    if visited not in after_only:
+                        add_resolved(visited, after)
+                    frame[6] = None
+
+                if not circular and pos < len(edges):
+                    edge_name = edges[pos]
+                    frame[3] = pos + 1
+                    edge = self.modules.get(edge_name)
+                    if edge == None:
+                        if node not in after_only:
+                            self._warn('%(module)s has a dependency on unknown'
+                                       ' "%(invalid)s" module' % \
+                                           {'module'  : node.name,
+                                            'invalid' : edge_name})
+                    # do not skip <after> modules because a previous visited
+                    # <after> module may later be a hard dependency
+                    elif edge_name not in skip_set and \
+                            kept_at.get(edge, entered_at) >= entered_at:
+                        if edge in seen_set:
+                            # circular dependency detected
+                            frame[5] = True
+                            if self.raise_exception_on_warning:
+                                # Translation of string not required - used in
+                                # unit tests only
+                                raise UsageError('Circular dependencies detected')
+                            if warn_about_circular_dependencies:
+                                self._warn('Circular dependencies detected: %s' \
+                                           % ' -> '.join([i.name for i in seen] \
+                                                         + [edge.name]))
+                        elif edge_name in node.after:
+                            stack.append(enter(edge, True))
                         elif edge_name in node.suggests:
-                            dep_resolve(edge, resolved, seen, after)
+                            stack.append(enter(edge, after))
                         elif edge_name in node.dependencies:
-                            dep_resolve(edge, resolved, seen, after)
-                            # hard dependency may be missed if a cyclic
-                            # dependency. Add it:
-                            if edge not in [i[0] for i in resolved]:
-                                resolved.append((edge, after))
-
-            seen.remove(node)
-
-            if not circular:
-                if node not in [i[0] for i in resolved]:
-                    resolved.append((node, after))
-                elif not after:
-                    # a dependency exists for an after, flag to keep
-                    for index, item in enumerate(resolved):
-                        if item[1] == True and item[0] == node:
-                            resolved[index] = (node, False)
+                            frame[6] = edge
+                            stack.append(enter(edge, after))
+                    continue
+
+                stack.pop()
+                seen.pop()
+                seen_set.discard(node)
+
+                if not circular:
+                    if node not in after_only:
+                        add_resolved(node, after)
+                    elif not after and after_only[node]:
+                        # a dependency exists for an after, flag to keep
+                        after_only[node] = False
+                        kept_at[node] = clock[0]
+                        clock[0] += 1
+
+        def add_resolved(node, after):
+            resolved.append(node)
+            after_only[node] = after
+            if not after:
+                kept_at[node] = clock[0]
+                clock[0] += 1
 
         if module_names == 'all':
             module_names = self.modules.keys()
         try:
             # remove skip modules from module_name list
             modules = [self.get_module(module, ignore_case = True) \
-                       for module in module_names if module not in skip]
+                       for module in module_names if module not in skip_set]
         except KeyError as e:
             raise UsageError("A module called '%s' could not be found." % e)
 
-        resolved = []
         for module in modules:
-            dep_resolve(module, resolved, [], False)
+            dep_resolve(module)
 
         if include_afters:
-            module_list = [module[0] for module in resolved]
+            module_list = resolved
         else:
-            module_list = [module for module, after_module in resolved \
-                           if not after_module]
+            module_list = [module for module in resolved \
+                           if not after_only[module]]
 
-        if '*' in skip:
+        if '*' in skip_set:
+            wanted = set(self.config.modules)
             module_list = [module for module in module_list \
-                           if module.name in self.config.modules]
+                           if module.name in wanted]
         
         return module_list
 
@@ -218,12 +389,8 @@ class ModuleSet:
 
     def remove_tag_modules(self, modules, tags):
         if tags:
-            return_list = []
-            for module in modules:
-                for tag in tags:
-                    if tag in self.modules[module.name].tags:
-                        return_list.append(module)
-            return return_list
+            tagged = self.get_tagged_modules(tags)
+            return [module for module in modules if module.name in tagged]
         else:
             return modules
 
@@ -299,7 +466,9 @@ class ModuleSet:
             logging.warn(msg)
 
 
-def load(config, uri=None):
+def load(config, uri=None, use_lockfile=True):
+    if uri is None and use_lockfile and config.lockfile:
+        return load_lockfile(config, config.lockfile)
     if uri is not None:
         modulesets = [ uri ]
     elif type(config.moduleset) in (list, tuple):
@@ -307,6 +476,7 @@ def load(config, uri=None):
     else:
         modulesets = [ config.moduleset ]
     ms = ModuleSet(config = config)
+    uris = []
     for uri in modulesets:
         if os.path.isabs(uri):
             pass
@@ -319,9 +489,184 @@ def load(config, uri=None):
         elif not urlparse(uri)[0]:
             uri = 'https://git.gnome.org/browse/icbuild/plain/modulesets' \
                   '/%s.modules' % uri
-        ms.modules.update(_parse_module_set(config, uri).modules)
+        uris.append(uri)
+
+    if config.cache_modulesets:
+        compiled = _load_compiled(config, uris)
+        if compiled is not None:
+            ms.modules.update(compiled[0])
+            ms.uris = compiled[1]
+            return ms
+
+    loader = _ModuleSetLoader(config)
+    try:
+        loader.prefetch(uris)
+        for uri in uris:
+            ms.modules.update(_parse_module_set(config, uri, loader).modules)
+    finally:
+        loader.close()
+    ms.uris = [uri for uri, digest in loader.loaded]
+    if config.cache_modulesets:
+        _save_compiled(config, uris, loader.loaded, ms.modules)
+    return ms
+
+def freeze(config, module_set):
+    '''Return the content of a lock file for module_set, with the build
+    order of the configured modules.'''
+    include_suggests = not config.ignore_suggests
+    module_list = module_set.get_full_module_list(
+            config.modules, config.skip, include_suggests=include_suggests)
+    modules = config.modules
+    if not isinstance(modules, str):
+        modules = list(modules)
+    default_repo = None
+    if _default_repo is not None:
+        default_repo = _default_repo.to_lock()
+    return {'moduleset': config.moduleset,
+            'conditions': sorted(config.conditions),
+            'prefix': config.prefix,
+            'build': {'modules': modules,
+                      'skip': list(config.skip),
+                      'include-suggests': include_suggests,
+                      'order': [module.name for module in module_list]},
+            'default-repository': default_repo,
+            'modules': [module.to_lock() for module in module_set.modules.values()]}
+
+def load_lockfile(config, filename):
+    '''Load the module set frozen in filename by "icbuild freeze".'''
+    global _default_repo
+    data = lockfile.read(filename)
+    if data['conditions'] != sorted(config.conditions):
+        logging.warning('%s was frozen with other conditions (%s)'
+                        % (filename, ', '.join(data['conditions'])))
+    if data['prefix'] != config.prefix:
+        logging.warning('%s was frozen with another prefix (%s)'
+                        % (filename, data['prefix']))
+    ms = ModuleSet(config = config)
+    for module_data in data['modules']:
+        module_class = lockfile.get_class(module_data['class'])
+        ms.add(module_class.from_lock(config, module_data))
+    if data['default-repository']:
+        repo_class = lockfile.get_class(data['default-repository']['class'])
+        _default_repo = repo_class.from_lock(config, data['default-repository'])
+    ms.frozen_build = data['build']
     return ms
 
+# Compiled modulesets
+#
+# Parsing the moduleset files and creating all the modules takes a good
+# share of the startup time of every command, so the result is pickled
+# in cacheroot.  The file name of the compiled form is a hash of the
+# moduleset URIs and of the settings that influence parsing; its header
+# lists the files that were read, with a hash of their contents, so any
+# change to a moduleset or one of its includes recompiles it.
+
+_COMPILED_VERSION = 3
+
+def _hash_file(filename):
+    fp = open(filename, 'rb')
+    try:
+        return hashlib.sha1(fp.read()).hexdigest()
+    finally:
+        fp.close()
+
+def _get_compiled_filename(config, uris):
+    key = hashlib.sha1()
+    for value in (_COMPILED_VERSION, uris,
+                  sorted(config.conditions),
+                  sorted(config.repos.items()),
+                  sorted(config.branches.items()),
+                  # not settings of their own, they may be set in the
+                  # configuration file
+                  getattr(config, 'mirror_policy', None),
+                  sorted(getattr(config, 'module_mirror_policy', {}).items()),
+                  config.prefix, config.checkoutroot):
+        key.update(repr(value).encode('utf-8'))
+    # the pickled modules depend on the code of their classes
+    for package in (modtypes, versioncontrol):
+        dirname = os.path.dirname(package.__file__)
+        for name in sorted(os.listdir(dirname)):
+            if name.endswith('.py'):
+                mtime = os.stat(os.path.join(dirname, name)).st_mtime
+                key.update(('%s:%r' % (name, mtime)).encode('utf-8'))
+    cachedir = os.path.join(os.path.expanduser(config.cacheroot), 'modulesets')
+    return os.path.join(cachedir, key.hexdigest() + '.pickle')
+
+class _CompiledPickler(pickle.Pickler):
+    '''Pickler that leaves the configuration object out, it is given back
+    to the modules when unpickling.'''
+
+    def __init__(self, fp, config):
+        pickle.Pickler.__init__(self, fp, pickle.HIGHEST_PROTOCOL)
+        self.config = config
+
+    def persistent_id(self, obj):
+        if obj is self.config:
+            return 'config'
+        return None
+
+class _CompiledUnpickler(pickle.Unpickler):
+    def __init__(self, fp, config):
+        pickle.Unpickler.__init__(self, fp)
+        self.config = config
+
+    def persistent_load(self, pid):
+        if pid == 'config':
+            return self.config
+        raise pickle.UnpicklingError('unknown persistent id %r' % pid)
+
+def _load_compiled(config, uris):
+    '''Return the modules of the compiled form of the modulesets and the
+    URIs of their files, or None if there is none or it is out of date.'''
+    global _default_repo
+    filename = _get_compiled_filename(config, uris)
+    if not os.path.exists(filename):
+        return None
+    try:
+        fp = open(filename, 'rb')
+        loader = _ModuleSetLoader(config)
+        try:
+            unpickler = _CompiledUnpickler(fp, config)
+            loaded = unpickler.load()
+            loader.prefetch([uri for uri, digest in loaded])
+            for uri, digest in loaded:
+                try:
+                    if _hash_file(loader.fetch(uri)) != digest:
+                        return None
+                except (EnvironmentError, RuntimeError):
+                    # let the real parser report the problem
+                    return None
+            modules, default_repo = unpickler.load()
+        finally:
+            loader.close()
+            fp.close()
+    except (EnvironmentError, EOFError, ValueError, ImportError,
+            pickle.UnpicklingError) as e:
+        # unreadable, or written by another version
+        logging.info('ignoring compiled moduleset: %s' % e)
+        return None
+    _default_repo = default_repo
+    return modules, [uri for uri, digest in loaded]
+
+def _save_compiled(config, uris, loaded, modules):
+    filename = _get_compiled_filename(config, uris)
+    try:
+        fileutils.mkdir_with_parents(os.path.dirname(filename))
+        writer = fileutils.SafeWriter(filename, 'wb')
+        try:
+            pickler = _CompiledPickler(writer.fp, config)
+            pickler.dump(loaded)
+            pickler.dump((dict(modules), _default_repo))
+        except:
+            writer.abandon()
+            raise
+        writer.commit()
+    except EnvironmentError as e:
+        logging.info('could not save compiled moduleset: %s' % e)
+    except (TypeError, pickle.PicklingError) as e:
+        # a module holds something that cannot be pickled
+        logging.warning('could not save compiled moduleset: %s' % e)
+
 def _child_elements(parent):
     for node in parent.childNodes:
         if node.nodeType == node.ELEMENT_NODE:
@@ -332,72 +677,301 @@ def _child_elements_matching(parent, names):
         if node.nodeType == node.ELEMENT_NODE and node.nodeName in names:
             yield node
 
-def _handle_conditions(config, element):
+class _Node:
+    ELEMENT_NODE = 1
+    TEXT_NODE = 3
+
+class _Element(_Node):
+    """An element of a parsed moduleset, providing the part of the minidom
+    API used by the module types."""
+
+    nodeType = _Node.ELEMENT_NODE
+
+    def __init__(self, name, attributes):
+        self.nodeName = name
+        self.attributes = attributes
+        self.childNodes = []
+
+    tagName = property(lambda self: self.nodeName)
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, '')
+
+    def hasAttribute(self, name):
+        return name in self.attributes
+
+    def normalize(self):
+        # adjacent text is already merged by the parser
+        pass
+
+class _Text(_Node):
+    nodeType = _Node.TEXT_NODE
+
+    def __init__(self, data):
+        self.data = data
+
+    nodeValue = property(lambda self: self.data)
+
+class _ModuleSetParser:
     """
-    If we encounter an <if> tag, consult the conditions set in the config
-    in order to decide if we should include its content or not.  If the
-    condition is met, the child elements are added to the parent of the
-    <if/> tag as if the condition tag were not there at all.  If the
-    condition is not met, the entire content is simply dropped.
+    Parse a moduleset file with expat into a tree of _Element nodes.
 
-    We do the processing as a transformation on the DOM as a whole,
-    immediately after parsing the moduleset XML, before doing any additional
-    processing.  This allows <if> to be used for anything and it means we
-    don't need to deal with it separately from each place.
+    <if> tags are handled while parsing: the conditions set in the config
+    decide if their content is kept.  The content of an <if> whose
+    condition is not met is skipped without creating any node; the child
+    elements of the others are moved to the end of the parent of the <if>
+    as if the condition tag were not there at all.  This allows <if> to be
+    used for anything and it means we don't need to deal with it
+    separately from each place.
 
     Although the tool itself will accept <if> anywhere we use the schemas to
     restrict its use to the purposes of conditionalising dependencies
     (including suggests) and {autogen,make,makeinstall}args.
+
+    Text made only of whitespace is dropped, unless it is the whole
+    content of an element.
     """
 
-    for condition_tag in _child_elements_matching(element, ['if']):
-        # In all cases, we remove the element from the parent
-        element.childNodes.remove(condition_tag)
+    def __init__(self, config):
+        self.config = config
+        self.document = None
+        self.redirect = None
+        self._stack = []
+        self._text = []
+        # depth inside an <if> whose condition is not met
+        self._skip = 0
 
-        # grab the condition from the attributes
-        c_if = condition_tag.getAttribute('condition-set')
-        c_unless = condition_tag.getAttribute('condition-unset')
+    def parse(self, filename):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        fp = open(filename, 'rb')
+        try:
+            parser.ParseFile(fp)
+        finally:
+            fp.close()
+        return self.document
+
+    def _check_condition(self, attrs):
+        c_if = attrs.get('condition-set')
+        c_unless = attrs.get('condition-unset')
 
         if (not c_if) == (not c_unless):
             raise FatalError("<if> must have exactly one of condition-set='' or condition-unset=''")
 
-        # check the condition
-        condition_true = ((c_if and c_if in config.conditions) or
-                          (c_unless and c_unless not in config.conditions))
+        return bool((c_if and c_if in self.config.conditions) or
+                    (c_unless and c_unless not in self.config.conditions))
+
+    def _flush_text(self, keep_whitespace):
+        data = ''.join(self._text)
+        self._text = []
+        if keep_whitespace or data.strip():
+            self._stack[-1].childNodes.append(_Text(data))
+
+    def _start_element(self, name, attrs):
+        if self._skip:
+            self._skip += 1
+            return
+        if self._text:
+            self._flush_text(False)
+        if name == 'if' and not self._check_condition(attrs):
+            self._skip = 1
+            return
+        element = _Element(name, attrs)
+        if self._stack:
+            self._stack[-1].childNodes.append(element)
+        else:
+            self.document = element
+        self._stack.append(element)
+
+    def _end_element(self, name):
+        if self._skip:
+            self._skip -= 1
+            return
+        element = self._stack[-1]
+        if self._text:
+            self._flush_text(not element.childNodes)
+        self._stack.pop()
+        if name != 'if':
+            self._expand_conditions(element)
+        if (name == 'redirect' and self.redirect is None and
+                len(self._stack) == 1):
+            self.redirect = element
+
+    def _character_data(self, data):
+        if self._stack and not self._skip:
+            self._text.append(data)
 
-        if condition_true:
-            # add the child elements of <condition> back into the parent
-            for condition_child in _child_elements(condition_tag):
-                element.childNodes.append(condition_child)
+    def _expand_conditions(self, element):
+        """Replace the <if> children of element, whose condition is met,
+        by their child elements, added at the end."""
+        conditions = [x for x in element.childNodes
+                      if x.nodeType == x.ELEMENT_NODE and x.nodeName == 'if']
+        if not conditions:
+            return
+        children = [x for x in element.childNodes
+                    if not (x.nodeType == x.ELEMENT_NODE and x.nodeName == 'if')]
+        while conditions:
+            condition_tag = conditions.pop(0)
+            for child in _child_elements(condition_tag):
+                if child.nodeName == 'if':
+                    conditions.append(child)
+                else:
+                    children.append(child)
+        element.childNodes = children
+
+class _ModuleSetLoader:
+    '''Downloads the files of the modulesets being loaded.
+
+    The includes of a moduleset are fetched, or revalidated, concurrently
+    as soon as it is parsed, while they are still processed one at a time
+    in document order.  The URIs of the files read, with a hash of their
+    contents, are kept in loaded.
+
+    It also remembers the files already parsed, so that a file included
+    by several others is only parsed once, and the ones being parsed, to
+    detect include cycles.'''
+
+    max_workers = 8
+
+    def __init__(self, config):
+        self.config = config
+        self.loaded = []
+        self.parsed = {}
+        self.parsing = []
+        self._executor = None
+        self._futures = {}
+
+    def _load(self, uri):
+        if (self.config.moduleset_revalidate == 'background' and
+                not self.config.nonetwork and
+                urlparse(uri)[0] in ('http', 'https', 'ftp')):
+            try:
+                filename = httpcache.load(uri, nonetwork=True)
+            except RuntimeError:
+                # not cached yet
+                pass
+            else:
+                _start_revalidation(uri, filename)
+                return filename
+        return httpcache.load(uri, nonetwork=self.config.nonetwork, age=0)
+
+    def prefetch(self, uris):
+        '''Start downloading the files at uris in the background.'''
+        if self.config.nonetwork:
+            return
+        for uri in uris:
+            if uri in self._futures or not urlparse(uri)[0] in ('http', 'https', 'ftp'):
+                continue
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+            self._futures[uri] = self._executor.submit(self._load, uri)
+
+    def fetch(self, uri):
+        '''Return the local file name for uri.'''
+        future = self._futures.pop(uri, None)
+        if future is None:
+            return self._load(uri)
+        return future.result()
+
+    def close(self):
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = {}
 
-    # now, recurse
-    for c in _child_elements(element):
-        _handle_conditions(config, c)
+# seconds a background revalidation waits for the server
+_REVALIDATE_TIMEOUT = 30
+# seconds the exit of a command waits for revalidations still running
+_REVALIDATE_EXIT_WAIT = 3
 
-def _parse_module_set(config, uri):
+_revalidations = []
+_revalidations_lock = threading.Lock()
+
+def _start_revalidation(uri, filename):
+    '''Revalidate uri in a daemon thread.  Short commands are often done
+    before the server answers, so the exit waits a little for it; past
+    that the thread is stopped, which is harmless as the cache writes the
+    file and its index record atomically.'''
+    thread = threading.Thread(target=_revalidate, args=(uri, filename),
+                              name='revalidate %s' % uri)
+    thread.daemon = True
+    with _revalidations_lock:
+        if not _revalidations:
+            atexit.register(_wait_revalidations)
+        _revalidations.append(thread)
+    thread.start()
+
+def _wait_revalidations():
+    deadline = time.time() + _REVALIDATE_EXIT_WAIT
+    with _revalidations_lock:
+        threads = list(_revalidations)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+def _revalidate(uri, filename):
+    '''Check whether the copy of uri in filename is still current.'''
+    try:
+        digest = _hash_file(filename)
+        if _hash_file(httpcache.load(uri, age=0,
+                                     timeout=_REVALIDATE_TIMEOUT)) != digest:
+            logging.warning('%s has changed, the new version will be used '
+                            'from the next run on' % uri)
+    except Exception as e:
+        logging.info('could not check %s for updates: %s' % (uri, e))
+
+def _parse_module_set(config, uri, loader=None):
+    if loader is None:
+        loader = _ModuleSetLoader(config)
+    key = uri
+    if os.path.isabs(uri) or not urlparse(uri)[0]:
+        key = os.path.normpath(uri)
+    if key in loader.parsed:
+        return loader.parsed[key]
+    if key in loader.parsing:
+        cycle = loader.parsing[loader.parsing.index(key):] + [key]
+        raise IncludeCycleError('modulesets include each other: %s'
+                                % ' -> '.join(cycle))
+    loader.parsing.append(key)
+    try:
+        moduleset = _read_module_set(config, uri, loader)
+    finally:
+        loader.parsing.pop()
+    loader.parsed[key] = moduleset
+    return moduleset
+
+def _read_module_set(config, uri, loader):
     try:
-        filename = httpcache.load(uri, nonetwork=config.nonetwork, age=0)
+        filename = loader.fetch(uri)
     except Exception as e:
         raise FatalError('could not download %s: %s' % (uri, e))
     filename = os.path.normpath(filename)
     try:
-        document = xml.dom.minidom.parse(filename)
+        loader.loaded.append((uri, _hash_file(filename)))
+    except IOError as e:
+        raise FatalError('failed to parse %s: %s' % (filename, e))
+    parser = _ModuleSetParser(config)
+    try:
+        root = parser.parse(filename)
     except IOError as e:
         raise FatalError('failed to parse %s: %s' % (filename, e))
     except xml.parsers.expat.ExpatError as e:
         raise FatalError('failed to parse %s: %s' % (uri, e))
 
-    assert document.documentElement.nodeName == 'moduleset'
+    assert root.nodeName == 'moduleset'
 
-    for node in _child_elements_matching(document.documentElement, ['redirect']):
-        new_url = node.getAttribute('href')
+    if parser.redirect is not None:
+        new_url = parser.redirect.getAttribute('href')
         logging.info('moduleset is now located at %s', new_url)
-        return _parse_module_set(config, new_url)
-
-    _handle_conditions(config, document.documentElement)
+        return _parse_module_set(config, new_url, loader)
 
     moduleset = ModuleSet(config = config)
-    moduleset_name = document.documentElement.getAttribute('name')
+    moduleset_name = root.getAttribute('name')
     if not moduleset_name:
         moduleset_name = os.path.basename(uri)
         if moduleset_name.endswith('.modules'):
@@ -407,7 +981,7 @@ def _parse_module_set(config, uri):
     repositories = {}
     default_repo = None
     for node in _child_elements_matching(
-            document.documentElement, ['repository', 'cvsroot', 'svnroot',
+            root, ['repository', 'cvsroot', 'svnroot',
                                        'arch-archive']):
         name = node.getAttribute('name')
         if node.getAttribute('default') == 'yes':
@@ -453,14 +1027,18 @@ def _parse_module_set(config, uri):
             repositories[name] = repo_type(config, name,
                                            archive=name, href=archive_uri)
 
+    # fetch all the includes at once, they are parsed in order below
+    loader.prefetch([urljoin(uri, node.getAttribute('href'))
+                     for node in _child_elements_matching(root, ['include'])])
+
     # and now module definitions
-    for node in _child_elements(document.documentElement):
+    for node in _child_elements(root):
         if node.nodeName == 'include':
             href = node.getAttribute('href')
             inc_uri = urljoin(uri, href)
             try:
-                inc_moduleset = _parse_module_set(config, inc_uri)
-            except UndefinedRepositoryError:
+                inc_moduleset = _parse_module_set(config, inc_uri, loader)
+            except (UndefinedRepositoryError, IncludeCycleError):
                 raise
             except FatalError as e:
                 if inc_uri[0] == '/':
@@ -468,7 +1046,7 @@ def _parse_module_set(config, uri):
                 # look up in local modulesets
                 inc_uri = os.path.join(os.path.dirname(__file__), '..', 'modulesets',
                                    href)
-                inc_moduleset = _parse_module_set(config, inc_uri)
+                inc_moduleset = _parse_module_set(config, inc_uri, loader)
 
             moduleset.modules.update(inc_moduleset.modules)
         elif node.nodeName in ['repository', 'cvsroot', 'svnroot',
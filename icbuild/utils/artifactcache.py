@@ -0,0 +1,104 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   artifactcache.py - a content addressed store of installed modules
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Cache of the DESTDIR trees produced by building modules.  The files
+modules install straight into the prefix are stored with the same layout.
+
+Artifacts are keyed on Package.get_input_hash(), which covers the source
+tree, the build arguments and the keys of the dependencies, so a module
+built once with identical inputs, on this host or on another one sharing
+the directory, can be installed again without running any build phase.
+'''
+
+import os
+import tarfile
+
+from icbuild.utils import fileutils
+
+__all__ = ['ArtifactCache']
+
+
+def _check_members(root, members):
+    '''Raise TarError unless every member ends up inside root.'''
+    links = set()
+    for member in members:
+        name = os.path.normpath(member.name)
+        if (os.path.isabs(member.name) or name == os.pardir or
+                name.startswith(os.pardir + os.sep)):
+            raise tarfile.TarError('invalid path in artifact: %s' % member.name)
+        # a file written through a symbolic link of the archive
+        parent = os.path.dirname(name)
+        while parent:
+            if parent in links:
+                raise tarfile.TarError('invalid path in artifact: %s' % member.name)
+            parent = os.path.dirname(parent)
+        if member.issym():
+            links.add(name)
+        elif member.islnk() and os.path.normpath(member.linkname).startswith(os.pardir):
+            raise tarfile.TarError('invalid link in artifact: %s' % member.name)
+        elif member.isdev():
+            raise tarfile.TarError('device file in artifact: %s' % member.name)
+
+
+class ArtifactCache:
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.tar.gz')
+
+    def has(self, key):
+        return os.path.exists(self._path(key))
+
+    def store(self, key, root, names=None):
+        '''Store the contents of the directory root as the artifact for
+        key, or only the files of names, relative to root, if given.  The
+        archive is written next to its final name and renamed into place,
+        so concurrent readers never see a partial file.'''
+        path = self._path(key)
+        fileutils.mkdir_with_parents(os.path.dirname(path))
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        pkg = tarfile.open(tmpname, 'w:gz')
+        try:
+            if names is None:
+                for name in sorted(os.listdir(root)):
+                    pkg.add(os.path.join(root, name), arcname=name)
+            else:
+                for name in names:
+                    pkg.add(os.path.join(root, name), arcname=name,
+                            recursive=False)
+        except:
+            pkg.close()
+            os.unlink(tmpname)
+            raise
+        pkg.close()
+        os.replace(tmpname, path)
+
+    def restore(self, key, root):
+        '''Unpack the artifact for key into the directory root.'''
+        pkg = tarfile.open(self._path(key), 'r:gz')
+        try:
+            if hasattr(tarfile, 'tar_filter'):
+                pkg.extractall(root, filter='tar')
+            else:
+                # the directory may be shared with other hosts, do not
+                # let an archive write outside of root
+                _check_members(root, pkg.getmembers())
+                pkg.extractall(root)
+        finally:
+            pkg.close()
@@ -0,0 +1,136 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   buildhistory.py - a record of how long build phases took
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import errno
+import threading
+
+try:
+    import xml.etree.ElementTree as ET
+except ImportError:
+    import elementtree.ElementTree as ET
+
+from icbuild.utils import fileutils
+from icbuild.utils.packagedb import _parse_isotime, _format_isotime
+
+__all__ = ['PhaseRun', 'BuildHistory']
+
+
+class PhaseRun:
+    def __init__(self, phase, start, duration, success, revision=None):
+        self.phase = phase # string
+        self.start = start # seconds since the epoch
+        self.duration = duration # wall time, in seconds
+        self.success = success # boolean
+        self.revision = revision # string or None
+
+    def to_xml(self):
+        node = ET.Element('run', {'phase': self.phase,
+                                  'start': _format_isotime(self.start),
+                                  'duration': '%.3f' % self.duration,
+                                  'status': self.success and 'ok' or 'failed'})
+        if self.revision:
+            node.attrib['revision'] = self.revision
+        return node
+
+    @classmethod
+    def from_xml(cls, node):
+        return cls(node.attrib['phase'],
+                   _parse_isotime(node.attrib['start']),
+                   float(node.attrib['duration']),
+                   node.attrib['status'] == 'ok',
+                   node.attrib.get('revision'))
+
+
+class BuildHistory:
+    '''Wall time and outcome of the last runs of each (module, phase).
+
+    Each module has its own file in dirname, holding at most max_runs
+    runs of every phase.'''
+
+    max_runs = 10
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _load(self, module):
+        if module in self._runs:
+            return self._runs[module]
+        runs = []
+        try:
+            doc = ET.parse(os.path.join(self.dirname, module))
+            for node in doc.getroot():
+                if node.tag == 'run':
+                    runs.append(PhaseRun.from_xml(node))
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (ET.ParseError, KeyError, ValueError):
+            # treat a damaged file like a missing one
+            pass
+        self._runs[module] = runs
+        return runs
+
+    def _write(self, module, runs):
+        root = ET.Element('history', {'module': module})
+        for run in runs:
+            root.append(run.to_xml())
+        fileutils.mkdir_with_parents(self.dirname)
+        writer = fileutils.SafeWriter(os.path.join(self.dirname, module))
+        ET.ElementTree(root).write(writer.fp, encoding='unicode')
+        writer.fp.write('\n')
+        writer.commit()
+
+    def add(self, module, phase, start, duration, success, revision=None):
+        '''Record a run of phase for module.'''
+        with self._lock:
+            runs = self._load(module)
+            runs.append(PhaseRun(phase, start, duration, success, revision))
+            phase_runs = [run for run in runs if run.phase == phase]
+            for run in phase_runs[:-self.max_runs]:
+                runs.remove(run)
+            self._write(module, runs)
+
+    def get_runs(self, module, phase=None):
+        '''Return the recorded runs for module, oldest first, optionally
+        restricted to a single phase.'''
+        with self._lock:
+            runs = self._load(module)
+        if phase is None:
+            return list(runs)
+        return [run for run in runs if run.phase == phase]
+
+    def estimate(self, module, phase):
+        '''Return the expected duration of phase for module, the median of
+        its recent successful runs, or None if it never ran.'''
+        durations = sorted([run.duration for run in self.get_runs(module, phase)
+                            if run.success])
+        if not durations:
+            return None
+        return durations[len(durations) // 2]
+
+    def estimate_module(self, module, phases):
+        '''Return the expected duration of running phases for module, or
+        None if none of them ever ran.'''
+        estimates = [self.estimate(module, phase) for phase in phases]
+        estimates = [x for x in estimates if x is not None]
+        if not estimates:
+            return None
+        return sum(estimates)
@@ -0,0 +1,119 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   buildjournal.py - a crash safe record of the progress of a build
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Journal of the steps completed by the current build.
+
+Every completed phase and every finished module is appended to the
+journal as one line of JSON, and synced to disk, so that whatever kills
+icbuild (reboot, OOM killer) the journal describes exactly what was done.
+"icbuild build --resume" replays it to carry on from the interrupted
+phase.  A build that succeeds removes its journal.
+
+Only "icbuild build" keeps a journal; other commands use a journal without
+a file, so that they leave the one of an interrupted build alone.
+'''
+
+import os
+import json
+import errno
+import threading
+
+from icbuild.utils import fileutils
+
+__all__ = ['BuildJournal']
+
+
+class BuildJournal:
+    def __init__(self, filename=None):
+        # with no file name, the journal is only kept in memory
+        self.filename = filename
+        self.modules = None # module list of the journaled build
+        self.built = set() # modules that were built successfully
+        self.failed = set() # modules that failed to build
+        self.phases = {} # module name -> set of completed phases
+        self._lock = threading.Lock()
+
+    def _append(self, record):
+        if self.filename is None:
+            return
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            fp = open(self.filename, 'a')
+            try:
+                fp.write(line)
+                fp.flush()
+                os.fsync(fp.fileno())
+            finally:
+                fp.close()
+
+    def load(self):
+        '''Read the journal of a previous build; returns False if there is
+        none.'''
+        if self.filename is None:
+            return False
+        try:
+            fp = open(self.filename)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last line cut short by a crash
+                break
+            event = record.get('event')
+            if event == 'start':
+                self.modules = record['modules']
+            elif event == 'phase':
+                self.phases.setdefault(record['module'], set()).add(record['phase'])
+            elif event == 'module':
+                if record['failed']:
+                    self.failed.add(record['module'])
+                else:
+                    self.built.add(record['module'])
+                    self.failed.discard(record['module'])
+        fp.close()
+        return True
+
+    def start(self, modules):
+        '''Start a new journal for a build of the given module names.'''
+        if self.filename is not None:
+            fileutils.ensure_unlinked(self.filename)
+        self.modules = modules
+        self.built = set()
+        self.failed = set()
+        self.phases = {}
+        self._append({'event': 'start', 'modules': modules})
+
+    def phase_done(self, module, phase):
+        self.phases.setdefault(module, set()).add(phase)
+        self._append({'event': 'phase', 'module': module, 'phase': phase})
+
+    def module_done(self, module, failed):
+        if failed:
+            self.failed.add(module)
+        else:
+            self.built.add(module)
+        self._append({'event': 'module', 'module': module, 'failed': failed})
+
+    def finish(self):
+        '''Remove the journal, the build went through.'''
+        if self.filename is not None:
+            fileutils.ensure_unlinked(self.filename)
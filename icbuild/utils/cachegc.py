@@ -0,0 +1,200 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   cachegc.py - keep the download caches under a size limit
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Eviction of the files downloaded by icbuild.
+
+The HTTP cache (modulesets and patches) and the tarball directory keep
+every file ever downloaded.  When together they take more than a given
+number of bytes, the files used least recently are removed until they fit
+again.  The index of the HTTP cache records when each entry was last used;
+tarballs get their modification time set whenever a build uses them.  The
+files the loaded module set refers to are never removed.  Lock files left
+behind by interrupted downloads are removed as well.
+
+When tarballdir is not set it is the checkout root, which holds more than
+tarballs; nothing is removed from it then.
+'''
+
+import os
+import re
+import stat
+import logging
+from urllib.parse import urlparse, urljoin
+
+from icbuild.errors import FatalError
+from icbuild.utils import fileutils
+from icbuild.utils import httpcache
+from icbuild.versioncontrol.tarball import TarballBranch
+
+__all__ = ['parse_size', 'format_size', 'get_referenced', 'collect']
+
+def parse_size(string):
+    '''Return the number of bytes of a size like 500M or 10G.'''
+    m = re.match(r'^\s*(\d+)\s*([kmgt]?)b?\s*$', str(string).lower())
+    if not m:
+        raise FatalError('invalid size: %s' % string)
+    return int(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2) or ' ')
+
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size = size / 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'bytes':
+        return '%d bytes' % size
+    return '%.1f %s' % (size, unit)
+
+def get_referenced(module_set):
+    '''Return the URIs of the HTTP cache entries and the paths of the
+    tarballs that module_set uses.'''
+    uris = set(module_set.uris)
+    if module_set.frozen_build is not None:
+        # loaded from a lock file, the moduleset files were not read
+        import icbuild.moduleset
+        uris.update(icbuild.moduleset.load(module_set.config,
+                                           use_lockfile=False).uris)
+    paths = set()
+    for module in module_set.modules.values():
+        branch = module.branch
+        if not isinstance(branch, TarballBranch):
+            continue
+        try:
+            paths.add(branch._local_tarball)
+        except FatalError:
+            pass
+        # the locations TarballBranch._do_patches() looks at
+        for patch, patchstrip in branch.patches:
+            if urlparse(patch)[0]:
+                uris.add(patch)
+            elif branch.repository.moduleset_uri:
+                for patch_prefix in ('.', 'patches', '../patches'):
+                    uris.add(urljoin(branch.repository.moduleset_uri,
+                                     os.path.join(patch_prefix, patch)))
+    return uris, paths
+
+def _get_cache_files(cache):
+    '''Return (last use, size, path, uri) for the entries of cache.'''
+    files = []
+    with cache._lock:
+        cache.read_cache()
+        entries = list(cache.entries.values())
+    for entry in entries:
+        path = os.path.join(cache.cachedir, entry.local)
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            continue
+        files.append((entry.accessed or st.st_mtime, st.st_size, path, entry.uri))
+    return files
+
+def _get_tarball_files(config, ignored):
+    '''Return (last use, size, path, None) for the tarballs.'''
+    tarballdir = config.tarballdir
+    if os.path.realpath(tarballdir) == os.path.realpath(config.checkoutroot):
+        return []
+    try:
+        names = os.listdir(tarballdir)
+    except EnvironmentError:
+        return []
+    files = []
+    for name in names:
+        path = os.path.join(tarballdir, name)
+        # downloads in progress and lock files
+        if name.endswith(('.lock', '.part', '.tmp')) or path in ignored:
+            continue
+        try:
+            st = os.lstat(path)
+        except EnvironmentError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        files.append((st.st_mtime, st.st_size, path, None))
+    return files
+
+def _remove_stale_locks(cache, tarballdir):
+    '''Remove the lock files nobody holds, an interrupted process may
+    have left them behind.'''
+    filenames = set()
+    for dirpath, dirnames, names in os.walk(cache.cachedir):
+        filenames.update([os.path.join(dirpath, name) for name in names])
+    if tarballdir is not None:
+        try:
+            filenames.update([os.path.join(tarballdir, name)
+                              for name in os.listdir(tarballdir)])
+        except EnvironmentError:
+            pass
+    filenames.discard(os.path.join(cache.cachedir, cache.lock_name))
+    for filename in sorted(filenames):
+        if not filename.endswith('.lock'):
+            continue
+        lock = fileutils.FileLock(filename, remove=True)
+        try:
+            if lock.acquire(blocking=False):
+                lock.release()
+        except EnvironmentError as e:
+            logging.warning('could not remove %s: %s' % (filename, e))
+
+def collect(config, module_set=None, max_size=None, dry_run=False):
+    '''Remove the least recently used downloaded files until they take
+    at most max_size bytes, config.cache_max_size by default.  Returns
+    the list of (path, size) of the files removed, or that would be with
+    dry_run.'''
+    if max_size is None:
+        max_size = config.cache_max_size
+    if max_size is None:
+        return []
+    uris, paths = set(), set()
+    if module_set is not None:
+        uris, paths = get_referenced(module_set)
+
+    cache = httpcache.get_cache()
+    files = _get_cache_files(cache)
+    # tarballdir may be the HTTP cache directory itself
+    ignored = set([path for accessed, size, path, uri in files])
+    for name in (cache.index_name, 'index.xml'):
+        ignored.add(os.path.join(cache.cachedir, name))
+    files.extend(_get_tarball_files(config, ignored))
+
+    total = sum([size for accessed, size, path, uri in files])
+    removed = []
+    for accessed, size, path, uri in sorted(files):
+        if total <= max_size:
+            break
+        if path in paths or uri in uris:
+            continue
+        if not dry_run:
+            try:
+                if uri is not None:
+                    cache.remove(uri)
+                else:
+                    # not while it is being downloaded again
+                    with fileutils.FileLock(path + '.lock', remove=True):
+                        fileutils.ensure_unlinked(path)
+            except EnvironmentError as e:
+                logging.warning('could not remove %s: %s' % (path, e))
+                continue
+        total -= size
+        removed.append((path, size))
+    if not dry_run:
+        tarballdir = config.tarballdir
+        if os.path.realpath(tarballdir) == os.path.realpath(config.checkoutroot):
+            tarballdir = None
+        _remove_stale_locks(cache, tarballdir)
+    return removed
@@ -0,0 +1,159 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   depgraph.py - reachability queries on the module dependency graph
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Transitive closures of the dependency graph of a module set.
+
+Modules are numbered, edges are kept as lists of numbers, and the set of
+modules reachable from each module is a Python integer used as a bitset,
+bit i standing for module i.  The closures of a given kind of edges are
+computed at once the first time they are needed: the strongly connected
+components are found with Tarjan's algorithm, which produces them in
+reverse topological order, so each component's closure is the union of
+its own bits and of the closures of the components it points to.  After
+that a query is a few integer operations, whatever the size of the graph.
+'''
+
+__all__ = ['DependencyGraph']
+
+EDGE_KINDS = ('dependencies', 'suggests', 'after')
+
+
+class DependencyGraph:
+    def __init__(self, modules):
+        '''modules is a sequence of Package objects; edges to modules not
+        in it are ignored.'''
+        self.names = [module.name for module in modules]
+        self.index = dict([(name, i) for i, name in enumerate(self.names)])
+        self.edges = {}
+        for kind in EDGE_KINDS:
+            self.edges[kind] = [
+                    sorted(set([self.index[dep] for dep in getattr(module, kind)
+                                if dep in self.index]))
+                    for module in modules]
+        self._closures = {}
+
+    def _get_successors(self, kinds, reverse):
+        successors = [[] for name in self.names]
+        for kind in kinds:
+            for i, targets in enumerate(self.edges[kind]):
+                for j in targets:
+                    if reverse:
+                        successors[j].append(i)
+                    else:
+                        successors[i].append(j)
+        return successors
+
+    def _compute_closures(self, successors):
+        '''Return the closure bitset of every node.'''
+        num = len(successors)
+        index = [None] * num
+        lowlink = [0] * num
+        on_stack = [False] * num
+        component = [None] * num
+        closures = []
+        stack = []
+        counter = 0
+
+        for root in range(num):
+            if index[root] is not None:
+                continue
+            # iterative Tarjan; work holds (node, position in successors)
+            work = [(root, 0)]
+            while work:
+                node, pos = work.pop()
+                if pos == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                recurse = False
+                succ = successors[node]
+                while pos < len(succ):
+                    target = succ[pos]
+                    pos += 1
+                    if index[target] is None:
+                        work.append((node, pos))
+                        work.append((target, 0))
+                        recurse = True
+                        break
+                    elif on_stack[target]:
+                        lowlink[node] = min(lowlink[node], index[target])
+                if recurse:
+                    continue
+                if lowlink[node] == index[node]:
+                    # node is the root of a component; every component it
+                    # points to is complete already
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component[member] = len(closures)
+                        members.append(member)
+                        if member == node:
+                            break
+                    bits = 0
+                    for member in members:
+                        bits |= 1 << member
+                    for member in members:
+                        for target in successors[member]:
+                            if component[target] != len(closures):
+                                bits |= closures[component[target]]
+                    closures.append(bits)
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+        return [closures[component[i]] for i in range(num)]
+
+    def _get_closures(self, kinds, reverse):
+        key = (tuple(sorted(kinds)), reverse)
+        if key not in self._closures:
+            self._closures[key] = self._compute_closures(
+                    self._get_successors(kinds, reverse))
+        return self._closures[key]
+
+    def closure(self, module_names, kinds=('dependencies',), reverse=False):
+        '''Return the bitset of the modules reachable from module_names,
+        themselves included, following edges of the given kinds; with
+        reverse, the modules from which one of module_names is reachable.
+        Unknown names are ignored.'''
+        closures = self._get_closures(kinds, reverse)
+        bits = 0
+        for name in module_names:
+            i = self.index.get(name)
+            if i is not None:
+                bits |= closures[i]
+        return bits
+
+    def bits(self, module_names):
+        '''Return the bitset of module_names.'''
+        bits = 0
+        for name in module_names:
+            i = self.index.get(name)
+            if i is not None:
+                bits |= 1 << i
+        return bits
+
+    def get_names(self, bits):
+        '''Return the names of the modules in bits, in index order.'''
+        names = []
+        while bits:
+            low = bits & -bits
+            names.append(self.names[low.bit_length() - 1])
+            bits ^= low
+        return names
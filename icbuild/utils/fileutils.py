@@ -22,6 +22,16 @@
 import os
 import sys
 import errno
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
 def _accumulate_dirtree_contents_recurse(path, contents):
     names = os.listdir(path)
@@ -51,6 +61,29 @@ in the returned list is relative to the root path."""
         contents[i] = subpath[pathlen:]
     return contents
 
+def hash_dirtree_contents(path, contents):
+    """Return a hex digest of the files and empty directories listed in
+CONTENTS, relative to the root PATH, as returned by
+accumulate_dirtree_contents().  It covers the names, file data and
+symbolic link targets, not timestamps or permissions."""
+    digest = hashlib.sha256()
+    for name in sorted(contents):
+        subpath = os.path.join(path, name)
+        if os.path.islink(subpath):
+            digest.update(('l %s %s\n' % (name, os.readlink(subpath))).encode('utf-8'))
+        elif name.endswith(os.sep):
+            digest.update(('d %s\n' % name).encode('utf-8'))
+        else:
+            file_digest = hashlib.sha256()
+            fp = open(subpath, 'rb')
+            data = fp.read(65536)
+            while data:
+                file_digest.update(data)
+                data = fp.read(65536)
+            fp.close()
+            digest.update(('f %s %s\n' % (name, file_digest.hexdigest())).encode('utf-8'))
+    return digest.hexdigest()
+
 def remove_files_and_dirs(file_paths, allow_nonempty_dirs=False):
     """Given a list of file paths in any order, attempt to delete
 them.  The main intelligence in this function is removing files
@@ -106,11 +139,16 @@ def _windows_rename(src, dst):
         os.unlink(dst)
         os.rename(src, dst)
 
+if sys.platform == 'win32':
+    rename = _windows_rename
+else:
+    rename = os.rename
+
 def ensure_unlinked(filename):
     try:
         os.unlink(filename)
     except OSError as e:
-        if e.errno != os.errno.ENOENT:
+        if e.errno != errno.ENOENT:
             raise
 
 def mkdir_with_parents(filename):
@@ -121,10 +159,10 @@ def mkdir_with_parents(filename):
             raise
 
 class SafeWriter(object):
-    def __init__(self, filename):
+    def __init__(self, filename, mode='w'):
         self.filename = filename
         self.tmpname = filename + '.tmp'
-        self.fp = open(self.tmpname, 'w')
+        self.fp = open(self.tmpname, mode)
 
     def commit(self):
         self.fp.flush()
@@ -139,3 +177,99 @@ class SafeWriter(object):
     def abandon(self):
         self.fp.close()
         os.unlink(self.tmpname)
+
+class FileLock(object):
+    '''An exclusive lock held on filename, which is created if needed,
+    to serialise work between processes.  It is not reentrant: within a
+    process, threads have to be serialised by other means.
+
+    With remove, the lock file is deleted on release, for locks taken on
+    many different names.  Processes that were waiting on the deleted file
+    then find it is no longer the one at filename, and lock again.  On
+    Windows an open file cannot be deleted, the lock file is left there.'''
+
+    def __init__(self, filename, remove=False):
+        self.filename = filename
+        self.remove = remove
+        self.fp = None
+
+    def acquire(self, blocking=True):
+        '''Lock the file; without blocking, return False at once if it
+        is locked already.'''
+        dirname = os.path.dirname(self.filename)
+        while True:
+            if dirname:
+                mkdir_with_parents(dirname)
+            fp = open(self.filename, 'a+b')
+            try:
+                if not self._lock(fp, blocking):
+                    fp.close()
+                    return False
+                if not self.remove or self._is_current(fp):
+                    break
+            except:
+                fp.close()
+                raise
+            # the holder removed the file while we were waiting
+            fp.close()
+        self.fp = fp
+        return True
+
+    def _lock(self, fp, blocking):
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fp.fileno(), flags)
+            except OSError as e:
+                if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+        elif msvcrt is not None:
+            fp.seek(0)
+            while True:
+                # LK_LOCK gives up after ten seconds
+                try:
+                    if blocking:
+                        msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    else:
+                        msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError as e:
+                    if not blocking and e.errno in (errno.EACCES, errno.EDEADLOCK):
+                        return False
+                    if e.errno != errno.EDEADLOCK:
+                        raise
+        return True
+
+    def _is_current(self, fp):
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        fst = os.fstat(fp.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def release(self):
+        fp, self.fp = self.fp, None
+        try:
+            if self.remove and fcntl is not None:
+                # still locked, nobody else can be using it
+                ensure_unlinked(self.filename)
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            fp.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -26,46 +26,74 @@ and draws ideas from feedparser.py.  Strategies include:
       resource to reduce downloads when the file has not changed.
     - honour Expires headers returned by server.  If no expiry time is
       given, it defaults to 6 hours.
+
+The file of a URI is named after the SHA-1 of the URI, in a subdirectory
+named after the first two digits of the hash (ab/ab12...), so that no
+directory holds too many files; the base name of the URI is only kept in
+the index.  The index also records when each entry was last used, for
+"icbuild cache gc" to remove the least recently used ones first.
+
+The cache directory can be shared by several icbuild processes: updates of
+the index are serialised by a lock on index.lock, and a URI is downloaded
+by one process at a time, holding a lock file next to the file of the URI;
+the processes waiting for it then use the file it downloaded.
 '''
 
 import os
 import sys
-import urllib
+import errno
+import hashlib
+import json
+import urllib.request
+import urllib.error
+import urllib.parse
 import time
 import email.utils
-import io
-try:
-    import gzip
-except ImportError:
-    gzip = None
+import threading
+import zlib
 
 try:
     import xml.dom.minidom
 except ImportError:
     raise SystemExit('Python XML packages are required but could not be found')
 
+from icbuild.utils import fileutils
+
 def _parse_isotime(string):
     if string[-1] != 'Z':
         return time.mktime(time.strptime(string, '%Y-%m-%dT%H:%M:%S'))
     tm = time.strptime(string, '%Y-%m-%dT%H:%M:%SZ')
     return time.mktime(tm[:8] + (0,)) - time.timezone    
 
-def _format_isotime(tm):
-    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(tm))
-
 def _parse_date(date):
     tm = email.utils.parsedate_tz(date)
     if tm:
         return email.utils.mktime_tz(tm)
     return 0
 
+def _hash_uri(uri):
+    return hashlib.sha1(uri.encode('utf-8')).hexdigest()
+
+def _get_basename(uri):
+    '''Return the file name the URI refers to.'''
+    parts = urllib.parse.urlparse(uri, allow_fragments=False)
+    return parts[2].split('/')[-1] or 'index.html'
+
 class CacheEntry:
-    def __init__(self, uri, local, modified, etag, expires=0):
+    def __init__(self, uri, local, modified, etag, expires=0, accessed=0,
+                 name=None):
         self.uri = uri
         self.local = local
         self.modified = modified
         self.etag = etag
         self.expires = expires
+        self.accessed = accessed
+        self.name = name or _get_basename(uri)
+
+    def to_record(self):
+        return {'uri': self.uri, 'local': self.local, 'name': self.name,
+                'modified': self.modified, 'etag': self.etag,
+                'expires': self.expires, 'accessed': self.accessed}
 
 class Cache:
     cachedir = os.path.expanduser('~/icbuild/cache')
@@ -73,16 +101,38 @@ class Cache:
     # default to a 6 hour expiry time.
     default_age = 6 * 60 * 60
 
+    index_name = 'index.jsonl'
+    lock_name = 'index.lock'
+
+    # downloads are written out in chunks of that many bytes
+    chunk_size = 64 * 1024
+
+    # rewrite the index when it holds that many records more than twice
+    # the number of entries
+    compact_threshold = 1000
+
+    # the time an entry was last used is only written to the index when
+    # it changed by at least that many seconds
+    access_resolution = 60 * 60
+
     def __init__(self, cachedir=None):
         if cachedir:
             self.cachedir = cachedir
         if not os.path.exists(self.cachedir):
             os.makedirs(self.cachedir)
         self.entries = {}
+        # held while the index is read or updated, so that several
+        # threads can download at the same time; the index lock file is
+        # only taken with it held
+        self._lock = threading.RLock()
+        # identity of the index file, how far it was read, and the
+        # number of records read from it
+        self._index_id = None
+        self._index_offset = 0
+        self._index_records = 0
 
-    def read_cache(self):
-        self.entries = {}
-        cindex = os.path.join(self.cachedir, 'index.xml')
+    def _read_xml_index(self, cindex):
+        '''Read the index of older versions, an XML file.'''
         try:
             document = xml.dom.minidom.parse(cindex)
         except:
@@ -111,55 +161,179 @@ class Cache:
                                                etag, expires)
         document.unlink()
 
+    def _apply_record(self, line):
+        try:
+            record = json.loads(line.decode('utf-8'))
+            uri = record['uri']
+            if record.get('deleted'):
+                self.entries.pop(uri, None)
+            else:
+                self.entries[uri] = CacheEntry(uri, record['local'],
+                                               record.get('modified'),
+                                               record.get('etag'),
+                                               record.get('expires', 0),
+                                               record.get('accessed', 0),
+                                               record.get('name'))
+        except (ValueError, KeyError, TypeError):
+            # a record damaged by a crash
+            pass
+        self._index_records += 1
+
+    def _index_lock(self):
+        return fileutils.FileLock(os.path.join(self.cachedir, self.lock_name))
+
+    def _uri_lock(self, uri):
+        filename = os.path.join(self.cachedir, self._make_filename(uri))
+        # one lock file per entry would pile up in the cache directory
+        return fileutils.FileLock(filename + '.lock', remove=True)
+
+    def read_cache(self):
+        '''Bring the entries up to date with the index.
+
+        The index is a log, with a line of JSON for every entry added,
+        updated or removed.  It is read in full once, later calls only
+        read the records appended since, by this or other processes.'''
+        cindex = os.path.join(self.cachedir, self.index_name)
+        old_index = os.path.join(self.cachedir, 'index.xml')
+        if (self._index_id is None and not os.path.exists(cindex) and
+                os.path.exists(old_index)):
+            with self._index_lock():
+                # another process may have converted it meanwhile
+                if os.path.exists(old_index) and not os.path.exists(cindex):
+                    self._read_xml_index(old_index)
+                    self._write_index()
+                    os.remove(old_index)
+        self._read_index()
+
+    def _read_index(self):
+        cindex = os.path.join(self.cachedir, self.index_name)
+        try:
+            fp = open(cindex, 'rb')
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            st = os.fstat(fp.fileno())
+            index_id = (st.st_dev, st.st_ino)
+            if index_id != self._index_id or st.st_size < self._index_offset:
+                # first read, or the index was compacted meanwhile
+                self.entries = {}
+                self._index_id = index_id
+                self._index_offset = 0
+                self._index_records = 0
+            fp.seek(self._index_offset)
+            data = fp.read()
+        finally:
+            fp.close()
+        # only read complete lines, the last one may still be written
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply_record(line)
+        self._index_offset += end
+
+    def _append_record(self, record):
+        cindex = os.path.join(self.cachedir, self.index_name)
+        line = json.dumps(record, sort_keys=True).encode('utf-8') + b'\n'
+        with self._index_lock():
+            fp = open(cindex, 'a+b')
+            try:
+                fp.seek(0, os.SEEK_END)
+                if fp.tell():
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':
+                        # end the line left unfinished by a crash
+                        line = b'\n' + line
+                fp.write(line)
+                fp.flush()
+                os.fsync(fp.fileno())
+            finally:
+                fp.close()
+            # pick up our record, and any written before it
+            self._read_index()
+            if self._index_records > self.compact_threshold + 2 * len(self.entries):
+                self._write_index()
+
+    def add_entry(self, entry):
+        '''Add or update entry, in memory and in the index.'''
+        self.entries[entry.uri] = entry
+        self._append_record(entry.to_record())
+
+    def remove_entry(self, uri):
+        self.entries.pop(uri, None)
+        self._append_record({'uri': uri, 'deleted': True})
+
+    def remove(self, uri):
+        '''Remove the entry of uri and its file from the cache; returns
+        the size of the file.'''
+        with self._uri_lock(uri):
+            with self._lock:
+                self.read_cache()
+                entry = self.entries.get(uri)
+                if entry is None:
+                    return 0
+                self.remove_entry(uri)
+            filename = os.path.join(self.cachedir, entry.local)
+            try:
+                size = os.stat(filename).st_size
+            except EnvironmentError:
+                return 0
+            fileutils.ensure_unlinked(filename)
+            return size
+
+    def _record_access(self, entry, now):
+        if now - entry.accessed < self.access_resolution:
+            return
+        with self._lock:
+            entry.accessed = now
+            self.add_entry(entry)
+
     def write_cache(self):
-        cindex = os.path.join(self.cachedir, 'index.xml')
-
-        
-        document = xml.dom.minidom.Document()
-        document.appendChild(document.createElement('cache'))
-        node = document.createTextNode('\n')
-        document.documentElement.appendChild(node)
-        for uri in self.entries.keys():
-            entry = self.entries[uri]
-            node = document.createElement('entry')
-            node.setAttribute('uri', entry.uri)
-            node.setAttribute('local', entry.local)
-            if entry.modified:
-                node.setAttribute('modified', entry.modified)
-            if entry.etag:
-                node.setAttribute('etag', entry.etag)
-            node.setAttribute('expires', _format_isotime(entry.expires))
-            document.documentElement.appendChild(node)
-
-            node = document.createTextNode('\n')
-            document.documentElement.appendChild(node)
-        fp = open(cindex, 'w')
-        document.writexml(fp)
-        document.unlink()
-        fp.close()
+        '''Write the index again, with a single record per entry.'''
+        with self._lock, self._index_lock():
+            # keep the records other processes added
+            self._read_index()
+            self._write_index()
+
+    def _write_index(self):
+        cindex = os.path.join(self.cachedir, self.index_name)
+        writer = fileutils.SafeWriter(cindex, 'wb')
+        for entry in self.entries.values():
+            writer.fp.write(json.dumps(entry.to_record(), sort_keys=True)
+                            .encode('utf-8') + b'\n')
+        writer.commit()
+        st = os.stat(cindex)
+        self._index_id = (st.st_dev, st.st_ino)
+        self._index_offset = st.st_size
+        self._index_records = len(self.entries)
 
     def _make_filename(self, uri):
-        '''picks a unique name for a new entry in the cache.
-        Very simplistic.'''
-        # get the basename from the URI
-        parts = urllib.parse(uri, allow_fragments=False)
-        base = parts[2].split('/')[-1]
-        if not base: base = 'index.html'
-
-        is_unique = False
-        while not is_unique:
-            is_unique = True
-            for uri in self.entries.keys():
-                if self.entries[uri].local == base:
-                    is_unique = False
-                    break
-            if not is_unique:
-                base = base + '-'
-        return base
-
-    def load(self, uri, nonetwork=False, age=None):
+        '''Return the name of the file of uri, relative to the cache
+        directory.'''
+        digest = _hash_uri(uri)
+        return os.path.join(digest[:2], digest)
+
+    def _download(self, response, fp):
+        '''Copy the body of response to fp, a chunk at a time, decoding it
+        if it is gzip encoded.'''
+        decoder = None
+        if response.headers.get('Content-Encoding', '') == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = response.read(self.chunk_size)
+            if not data:
+                break
+            if decoder is not None:
+                data = decoder.decompress(data)
+            fp.write(data)
+        if decoder is not None:
+            fp.write(decoder.flush())
+
+    def load(self, uri, nonetwork=False, age=None, timeout=None):
         '''Downloads the file associated with the URI, and returns a local
-        file name for contents.'''
+        file name for contents.  timeout, in seconds, bounds the wait
+        for the server.'''
         # pass file URIs straight through -- no need to cache them
         parts = urllib.parse.urlparse(uri)
         if parts[0] in ('', 'file'):
@@ -171,18 +345,39 @@ class Cache:
         now = time.time()
 
         # is the file cached and not expired?
-        self.read_cache()
-        entry = self.entries.get(uri)
+        entry = self._get_entry(uri)
         if entry and (age != 0 or nonetwork):
             if (nonetwork or now <= entry.expires):
+                self._record_access(entry, now)
                 return os.path.join(self.cachedir, entry.local)
 
         if nonetwork:
             raise RuntimeError('file not in cache, but not allowed to check network')
 
-        request = urllib.Request(uri)
-        if gzip:
-            request.add_header('Accept-encoding', 'gzip')
+        seen_expires = entry and entry.expires
+        with self._uri_lock(uri):
+            # another process or thread may have fetched the file while
+            # we were waiting for the lock
+            current = self._get_entry(uri)
+            if (current and now <= current.expires and
+                    current.expires != seen_expires):
+                self._record_access(current, now)
+                return os.path.join(self.cachedir, current.local)
+            return self._fetch(uri, current, now, age, timeout)
+
+    def _get_entry(self, uri):
+        '''Return the entry of uri, if its file exists.'''
+        with self._lock:
+            self.read_cache()
+            entry = self.entries.get(uri)
+        if entry and not os.path.exists(os.path.join(self.cachedir, entry.local)):
+            entry = None
+        return entry
+
+    def _fetch(self, uri, entry, now, age, timeout):
+        previous = entry
+        request = urllib.request.Request(uri)
+        request.add_header('Accept-encoding', 'gzip')
         if entry:
             if entry.modified:
                 request.add_header('If-Modified-Since', entry.modified)
@@ -190,34 +385,35 @@ class Cache:
                 request.add_header('If-None-Match', entry.etag)
 
         try:
-            response = urllib.parse.urlopen(request)
-
-            # get data, and gunzip it if it is encoded
-            data = response.read()
-            if gzip and response.headers.get('Content-Encoding', '') == 'gzip':
+            if timeout is None:
+                response = urllib.request.urlopen(request)
+            else:
+                response = urllib.request.urlopen(request, timeout=timeout)
+            try:
+                entry = CacheEntry(uri, self._make_filename(uri),
+                                   response.headers.get('Last-Modified'),
+                                   response.headers.get('ETag'))
+                filename = os.path.join(self.cachedir, entry.local)
+                # the lock of uri is held, nothing else writes that file
+                writer = fileutils.SafeWriter(filename, 'wb')
                 try:
-                    data = gzip.GzipFile(fileobj=io.StringIO(data)).read()
+                    self._download(response, writer.fp)
                 except:
-                    data = ''
-
+                    writer.abandon()
+                    raise
+                writer.commit()
+            finally:
+                response.close()
             expires = response.headers.get('Expires')
-            
-            # add new content to cache
-            entry = CacheEntry(uri, self._make_filename(uri),
-                               response.headers.get('Last-Modified'),
-                               response.headers.get('ETag'))
-            filename = os.path.join(self.cachedir, entry.local)
-            fp = open(filename, 'wb')
-            fp.write(data)
-            fp.close()
-        except urllib.HTTPError as e:
+        except urllib.error.HTTPError as e:
             if e.code == 304: # not modified; update validated
-                expires = e.hdrs.get('Expires')
+                expires = e.headers.get('Expires')
                 filename = os.path.join(self.cachedir, entry.local)
             else:
                 raise
 
         # set expiry date
+        entry.accessed = now
         entry.expires = _parse_date(expires)
         if entry.expires <= now: # ignore expiry times that have already passed
             if age is None:
@@ -225,14 +421,23 @@ class Cache:
             entry.expires = now + age
 
         # save cache
-        self.entries[uri] = entry
-        self.write_cache()
+        with self._lock:
+            self.add_entry(entry)
+        if previous and previous.local != entry.local:
+            # a file named by older versions
+            fileutils.ensure_unlinked(os.path.join(self.cachedir, previous.local))
         return filename
 
 _cache = None
-def load(uri, nonetwork=False, age=None):
+_cache_lock = threading.Lock()
+def get_cache():
+    '''Return the cache used by load().'''
+    global _cache
+    with _cache_lock:
+        if not _cache: _cache = Cache()
+    return _cache
+
+def load(uri, nonetwork=False, age=None, timeout=None):
     '''Downloads the file associated with the URI, and returns a local
     file name for contents.'''
-    global _cache
-    if not _cache: _cache = Cache()
-    return _cache.load(uri, nonetwork=nonetwork, age=age)
+    return get_cache().load(uri, nonetwork=nonetwork, age=age, timeout=timeout)
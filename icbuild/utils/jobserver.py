@@ -0,0 +1,100 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   jobserver.py: a GNU make compatible jobserver
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''A jobserver shared by all the make invocations of a build.
+
+GNU make coordinates parallel sub-makes through a pool of tokens: every
+make owns one implicit job slot and must take a token from the pool for
+each additional job it runs.  By creating the pool ourselves and handing
+it to each make through MAKEFLAGS, modules built at the same time share a
+single budget of config.jobs instead of each running "make -j jobs".
+Every module built while another one is running takes a token as well,
+for its make's implicit slot, so that the total stays within the budget.
+
+On POSIX the pool is a pipe holding one byte per token.  On Windows GNU
+make (4.0 and later) uses a named semaphore instead.
+'''
+
+import os
+import sys
+
+from icbuild.errors import FatalError
+
+__all__ = ['JobServer']
+
+
+class JobServer:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        # each make has one implicit slot, only extra jobs need tokens
+        self.tokens = max(jobs - 1, 1)
+        self.pass_fds = ()
+        if sys.platform.startswith('win'):
+            self._init_semaphore()
+        else:
+            self._init_pipe()
+
+    def _init_pipe(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_inheritable(self._read_fd, True)
+        os.set_inheritable(self._write_fd, True)
+        os.write(self._write_fd, b'+' * self.tokens)
+        self.pass_fds = (self._read_fd, self._write_fd)
+        self.auth = '%d,%d' % self.pass_fds
+
+    def _init_semaphore(self):
+        import ctypes
+        self._kernel32 = ctypes.windll.kernel32
+        self.auth = 'icbuild_jobserver_%d' % os.getpid()
+        self._handle = self._kernel32.CreateSemaphoreW(
+                None, self.tokens, self.tokens, self.auth)
+        if not self._handle:
+            raise FatalError('could not create jobserver semaphore %s' % self.auth)
+
+    def acquire(self):
+        '''Take a token from the pool, waiting until one is free.'''
+        if self.pass_fds:
+            os.read(self._read_fd, 1)
+        else:
+            INFINITE = 0xFFFFFFFF
+            self._kernel32.WaitForSingleObject(self._handle, INFINITE)
+
+    def release(self):
+        '''Give back a token taken by acquire().'''
+        if self.pass_fds:
+            os.write(self._write_fd, b'+')
+        else:
+            self._kernel32.ReleaseSemaphore(self._handle, 1, None)
+
+    def get_makeflags(self):
+        '''Return the MAKEFLAGS value to give a make so that it takes part
+        in this jobserver.'''
+        flags = '-j%d --jobserver-auth=%s' % (self.jobs, self.auth)
+        if self.pass_fds:
+            # make before 4.2 only understands the older spelling
+            flags += ' --jobserver-fds=%s' % self.auth
+        return flags
+
+    def close(self):
+        if self.pass_fds:
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+            self.pass_fds = ()
+        elif getattr(self, '_handle', None):
+            self._kernel32.CloseHandle(self._handle)
+            self._handle = None
@@ -0,0 +1,100 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   lockfile.py - frozen modulesets
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Lock files hold a moduleset as it was resolved by "icbuild freeze":
+every module with its branch (URL, version, hash, patches), and the build
+order of the configured modules, as JSON.  Loading one needs neither the
+moduleset files nor dependency resolution.
+
+Modules, branches and repositories are stored as the dictionary of their
+attributes, plus the name of their class; the to_lock() and from_lock()
+methods of those classes use the helpers below.
+'''
+
+import json
+
+from icbuild.errors import FatalError
+from icbuild.utils import fileutils
+
+__all__ = ['write', 'read', 'export_attrs', 'import_attrs', 'get_class']
+
+VERSION = 1
+
+def _is_json(value):
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all([_is_json(x) for x in value])
+    if isinstance(value, dict):
+        return all([isinstance(k, str) and _is_json(v) for k, v in value.items()])
+    return False
+
+def export_attrs(obj, exclude=()):
+    '''Return the public attributes of obj, but the ones in exclude, and
+    the name of its class.'''
+    data = {'class': '%s.%s' % (obj.__class__.__module__,
+                                obj.__class__.__name__)}
+    for key, value in vars(obj).items():
+        if key.startswith('_') or key in exclude:
+            continue
+        if not _is_json(value):
+            raise FatalError('cannot freeze attribute %s of %r' % (key, obj))
+        data[key] = value
+    return data
+
+def import_attrs(obj, data, exclude=()):
+    for key, value in data.items():
+        if key == 'class' or key in exclude:
+            continue
+        setattr(obj, key, value)
+
+def get_class(name):
+    '''Return the class with the given dotted name, from an icbuild
+    module.'''
+    module_name, class_name = name.rsplit('.', 1)
+    if module_name != 'icbuild' and not module_name.startswith('icbuild.'):
+        raise FatalError('invalid class %s in lock file' % name)
+    try:
+        module = __import__(module_name, {}, {}, [class_name])
+        return getattr(module, class_name)
+    except (ImportError, AttributeError):
+        raise FatalError('invalid class %s in lock file' % name)
+
+def write(filename, data):
+    data = dict(data, version=VERSION)
+    writer = fileutils.SafeWriter(filename)
+    try:
+        json.dump(data, writer.fp, indent=1, sort_keys=True)
+        writer.fp.write('\n')
+    except:
+        writer.abandon()
+        raise
+    writer.commit()
+
+def read(filename):
+    try:
+        fp = open(filename)
+        try:
+            data = json.load(fp)
+        finally:
+            fp.close()
+    except (EnvironmentError, ValueError) as e:
+        raise FatalError('could not read lock file %s: %s' % (filename, e))
+    if data.get('version') != VERSION:
+        raise FatalError('unsupported lock file version in %s' % filename)
+    return data
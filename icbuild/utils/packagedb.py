@@ -58,8 +58,9 @@ class PackageEntry:
         if not os.path.exists(os.path.join(self.dirname, 'manifests', self.package)):
             return None
         self._manifest = []
-        for line in file(os.path.join(self.dirname, 'manifests', self.package)):
-            self._manifest.append(line.strip())
+        with open(os.path.join(self.dirname, 'manifests', self.package)) as fp:
+            for line in fp:
+                self._manifest.append(line.strip())
         return self._manifest
 
     def set_manifest(self, value):
@@ -76,14 +77,19 @@ class PackageEntry:
         # write info file
         fileutils.mkdir_with_parents(os.path.join(self.dirname, 'info'))
         writer = fileutils.SafeWriter(os.path.join(self.dirname, 'info', self.package))
-        ET.ElementTree(self.to_xml()).write(writer.fp)
+        ET.ElementTree(self.to_xml()).write(writer.fp, encoding='unicode')
         writer.fp.write('\n')
         writer.commit()
 
         # write manifest
-        fileutils.mkdir_with_parents(os.path.join(self.dirname, 'manifests'))
-        writer = fileutils.SafeWriter(os.path.join(self.dirname, 'manifests', self.package))
-        writer.fp.write('\n'.join(self.manifest) + '\n')
+        manifest = os.path.join(self.dirname, 'manifests', self.package)
+        if self._manifest is None:
+            # the files installed are not known
+            fileutils.ensure_unlinked(manifest)
+            return
+        fileutils.mkdir_with_parents(os.path.dirname(manifest))
+        writer = fileutils.SafeWriter(manifest)
+        writer.fp.write('\n'.join(self._manifest) + '\n')
         writer.commit()
 
     def remove(self):
@@ -98,9 +104,15 @@ class PackageEntry:
                                           'version': self.version})
         if 'installed-date' in self.metadata:
             entry_node.attrib['installed'] = _format_isotime(self.metadata['installed-date'])
+        if 'changed-date' in self.metadata:
+            entry_node.attrib['changed'] = _format_isotime(self.metadata['changed-date'])
         if 'configure-hash' in self.metadata:
             entry_node.attrib['configure-hash'] = \
                 self.metadata['configure-hash']
+        if 'input-hash' in self.metadata:
+            entry_node.attrib['input-hash'] = self.metadata['input-hash']
+        if 'content-hash' in self.metadata:
+            entry_node.attrib['content-hash'] = self.metadata['content-hash']
 
         return entry_node
 
@@ -113,9 +125,19 @@ class PackageEntry:
         installed_string = node.attrib['installed']
         if installed_string:
             metadata['installed-date'] = _parse_isotime(installed_string)
+        changed_string = node.attrib.get('changed')
+        if changed_string:
+            metadata['changed-date'] = _parse_isotime(changed_string)
         configure_hash = node.attrib.get('configure-hash')
         if configure_hash:
             metadata['configure-hash'] = configure_hash
+        input_hash = node.attrib.get('input-hash')
+        if input_hash:
+            metadata['input-hash'] = input_hash
+
+        content_hash = node.attrib.get('content-hash')
+        if content_hash:
+            metadata['content-hash'] = content_hash
 
         dbentry = cls(package, version, metadata, dirname)
 
@@ -168,16 +190,37 @@ class PackageDB:
         '''Return entry if package is installed, otherwise return None.'''
         return PackageEntry.open(self.dirname, package)
 
-    def add(self, package, version, contents, configure_cmd = None):
-        '''Add a module to the install cache.'''
+    def add(self, package, version, contents, configure_cmd = None,
+            input_hash = None, content_hash = None):
+        '''Add a module to the install cache.
+
+        If content_hash is given and matches the one of the previous
+        install, the files installed did not change: the date they last
+        changed is left alone, so modules depending on this one are not
+        considered out of date.'''
         entry = self.get(package)
         if entry:
             metadata = entry.metadata
         else:
             metadata = {}
-        metadata['installed-date'] = time.time() # now
+        now = time.time()
+        if (content_hash and 'installed-date' in metadata and
+                metadata.get('content-hash') == content_hash):
+            logging.info('%s installed identical files, keeping change date' % package)
+            metadata.setdefault('changed-date', metadata['installed-date'])
+        else:
+            metadata['changed-date'] = now
+        metadata['installed-date'] = now
+        if content_hash:
+            metadata['content-hash'] = content_hash
+        else:
+            metadata.pop('content-hash', None)
         if configure_cmd:
-            metadata['configure-hash'] = hashlib.md5(configure_cmd).hexdigest()
+            metadata['configure-hash'] = hashlib.md5(configure_cmd.encode('utf-8')).hexdigest()
+        if input_hash:
+            metadata['input-hash'] = input_hash
+        else:
+            metadata.pop('input-hash', None)
         pkg = PackageEntry(package, version, metadata, self.dirname)
         pkg.manifest = contents
         pkg.write()
@@ -200,6 +243,14 @@ class PackageDB:
             return None
         return entry.metadata['installed-date']
 
+    def changedate(self, package):
+        '''Get the date the files installed by a module last changed.'''
+        entry = self.get(package)
+        if entry is None:
+            return None
+        return entry.metadata.get('changed-date',
+                                  entry.metadata['installed-date'])
+
     def uninstall(self, package_name):
         '''Remove a module from the install cache.'''
         entry = self.get(package_name)
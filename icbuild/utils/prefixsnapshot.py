@@ -0,0 +1,65 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   prefixsnapshot.py - find the files a build wrote into the prefix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Modules that do not install into a DESTDIR write their files straight
+into the prefix.  A snapshot of the prefix taken before such a module is
+built tells, afterwards, which files it added or modified.
+
+The files of other modules built at the same time cannot be told apart,
+so the changes seen are only meaningful for a module built alone.
+'''
+
+import os
+
+__all__ = ['PrefixSnapshot']
+
+
+class PrefixSnapshot:
+    def __init__(self, prefix, exclude=()):
+        self.prefix = os.path.normpath(prefix)
+        # directories of the prefix that do not hold installed files
+        self.exclude = set([os.path.normpath(path) for path in exclude])
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.prefix):
+            for name in dirnames[:]:
+                path = os.path.join(dirpath, name)
+                if path in self.exclude:
+                    dirnames.remove(name)
+                elif os.path.islink(path):
+                    # not walked into
+                    filenames.append(name)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    # removed meanwhile
+                    continue
+                files[os.path.relpath(path, self.prefix)] = (
+                        st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                        st.st_ino)
+        return files
+
+    def get_changes(self):
+        '''Return the names, relative to the prefix, of the files added or
+        modified since the snapshot was taken.'''
+        return sorted([name for name, state in self._scan().items()
+                       if self.files.get(name) != state])
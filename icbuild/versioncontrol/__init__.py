@@ -27,6 +27,7 @@ __all__ = [
 __metaclass__ = type
 
 from icbuild.errors import FatalError, BuildStateError
+from icbuild.utils import lockfile
 import os
 
 class Repository:
@@ -64,6 +65,20 @@ class Repository:
         """Return an sxml representation of this repository."""
         raise NotImplementedError
 
+    def to_lock(self):
+        """Return a dictionary of JSON values describing this repository,
+        for a lock file.  Mirrors are left out, branches already point to
+        the chosen one."""
+        return lockfile.export_attrs(self, ('config', 'mirrors'))
+
+    @classmethod
+    def from_lock(cls, config, data):
+        instance = cls.__new__(cls)
+        lockfile.import_attrs(instance, data)
+        instance.config = config
+        instance.mirrors = {}
+        return instance
+
     def get_sysdeps(self):
         return []
 
@@ -155,6 +170,15 @@ class Branch:
                 else:
                     self._checkout(buildscript)
 
+    def prefetch(self, buildscript):
+        """Fetch the sources in advance of checkout().
+
+        This may be called from a background thread while other modules
+        are being built, it should not do anything checkout() would
+        undo.  The default implementation does nothing.
+        """
+        pass
+
     def force_checkout(self, buildscript):
         """A more agressive version of checkout()."""
         self._wipedir(buildscript, self.srcdir)
@@ -164,6 +188,12 @@ class Branch:
         """A string identifier for the state of the working tree."""
         raise NotImplementedError
 
+    def get_build_inputs(self, buildscript):
+        """Return a list of strings describing what goes into the
+        source tree, apart from tree_id(), e.g. the contents of patches
+        applied to it."""
+        return []
+
     def _wipedir(self, buildscript, dir):
         if dir and dir != os.sep and os.path.exists(dir):
             buildscript.execute(['rm', '-rf', dir])
@@ -185,6 +215,33 @@ class Branch:
         """Return an sxml representation of this checkout."""
         raise NotImplementedError
 
+    def to_lock(self):
+        """Return a dictionary of JSON values describing this branch,
+        with its repository, for a lock file."""
+        data = lockfile.export_attrs(self, ('config', 'repository',
+                                            'checkoutroot', 'quilt'))
+        data['repository'] = self.repository.to_lock()
+        if hasattr(self, 'quilt'):
+            data['quilt'] = self.quilt and self.quilt.to_lock()
+        return data
+
+    @classmethod
+    def from_lock(cls, config, data):
+        instance = cls.__new__(cls)
+        lockfile.import_attrs(instance, data, ('repository', 'quilt'))
+        repository_class = lockfile.get_class(data['repository']['class'])
+        instance.repository = repository_class.from_lock(config,
+                                                         data['repository'])
+        instance.config = config
+        # local paths come from the configuration in use
+        instance.checkoutroot = config.checkoutroot
+        if data.get('quilt'):
+            quilt_class = lockfile.get_class(data['quilt']['class'])
+            instance.quilt = quilt_class.from_lock(config, data['quilt'])
+        elif 'quilt' in data:
+            instance.quilt = None
+        return instance
+
 _repo_types = {}
 def register_repo_type(name, repo_class):
     _repo_types[name] = repo_class
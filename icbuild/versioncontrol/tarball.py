@@ -21,12 +21,14 @@ __all__ = []
 __metaclass__ = type
 
 import os
+import shutil
 try:
     import hashlib
 except ImportError:
     import md5 as hashlib
 from urllib.parse import urlparse, urljoin
 import urllib
+import urllib.error
 import logging
 
 from icbuild.errors import FatalError, CommandError, BuildStateError
@@ -35,6 +37,7 @@ from icbuild.utils.cmds import has_command, get_output
 from icbuild.modtypes import get_branch
 from icbuild.utils.unpack import unpack_archive
 from icbuild.utils import httpcache
+from icbuild.utils import fileutils
 from icbuild.utils.sxml import sxml
 
 
@@ -196,24 +199,38 @@ class TarballBranch(Branch):
                 logging.warning('skipped hash check (missing support for %s)' % algo)
 
     def _download_tarball(self, buildscript, localfile):
-        """Downloads the tarball off the internet, using wget or curl."""
+        """Downloads the tarball off the internet, using wget or curl.
+
+        The tarball directory may be shared with other icbuild processes:
+        the download holds a lock, and goes to a .part file renamed once
+        complete, so that a process never sees a partial tarball, nor
+        downloads one that another process has just fetched."""
         extra_env = {
             'PATH': os.environ.get('UNMANGLED_PATH')
             }
+        partfile = localfile + '.part'
         lines = [
-            ['wget.exe', '--continue', self.module, '-O', localfile],
-            ['curl.exe', '--continue-at', '-', '-L', self.module, '-o', localfile]
+            ['wget.exe', '--continue', self.module, '-O', partfile],
+            ['curl.exe', '--continue-at', '-', '-L', self.module, '-o', partfile]
             ]
         lines = [line for line in lines if has_command(line[0])]
         if not lines:
             raise FatalError("unable to find wget or curl")
-        try:
-            return buildscript.execute(lines[0], extra_env = extra_env)
-        except CommandError:
-            # Cleanup potential leftover file
-            if os.path.exists(localfile):
-                os.remove(localfile)
-            raise
+        with fileutils.FileLock(localfile + '.lock', remove=True):
+            try:
+                self._check_tarball()
+                # downloaded while we were waiting for the lock
+                return
+            except BuildStateError:
+                pass
+            try:
+                res = buildscript.execute(lines[0], extra_env = extra_env)
+            except CommandError:
+                # Cleanup potential leftover file
+                fileutils.ensure_unlinked(partfile)
+                raise
+            os.replace(partfile, localfile)
+            return res
 
     def _download_and_unpack(self, buildscript):
         localfile = self._local_tarball
@@ -231,6 +248,12 @@ class TarballBranch(Branch):
             # don't have the tarball, try downloading it and check again
             res = self._download_tarball(buildscript, localfile)
             self._check_tarball()
+        # the modification time of tarballs tells "icbuild cache gc" which
+        # ones were used least recently
+        try:
+            os.utime(localfile, None)
+        except OSError:
+            pass
 
         # now to unpack it
         try:
@@ -245,50 +268,55 @@ class TarballBranch(Branch):
         if self.patches:
             self._do_patches(buildscript)
 
+    def _find_patch(self, buildscript, patch):
+        """Return the local file name of patch."""
+        patchfile = ''
+        if urlparse(patch)[0]:
+            # patch name has scheme, get patch from network
+            try:
+                patchfile = httpcache.load(patch, nonetwork=buildscript.config.nonetwork)
+            except urllib.error.HTTPError as e:
+                raise BuildStateError('could not download patch (error: %s)' % e.code)
+            except urllib.error.URLError as e:
+                raise BuildStateError('could not download patch')
+        elif self.repository.moduleset_uri:
+            # get it relative to the moduleset uri, either in the same
+            # directory or a patches/ subdirectory
+            for patch_prefix in ('.', 'patches', '../patches'):
+                uri = urljoin(self.repository.moduleset_uri,
+                        os.path.join(patch_prefix, patch))
+                try:
+                    patchfile = httpcache.load(uri, nonetwork=buildscript.config.nonetwork)
+                except Exception as e:
+                    continue
+                if not os.path.isfile(patchfile):
+                    continue
+                break
+            else:
+                patchfile = ''
+
+        if not patchfile:
+            # nothing else, use icbuild provided patches
+            possible_locations = []
+            if self.config.modulesets_dir:
+                possible_locations.append(os.path.join(self.config.modulesets_dir, 'patches'))
+                possible_locations.append(os.path.join(self.config.modulesets_dir, '../patches'))
+            if PKGDATADIR:
+                possible_locations.append(os.path.join(PKGDATADIR, 'patches'))
+            if SRCDIR:
+                possible_locations.append(os.path.join(SRCDIR, 'patches'))
+            for dirname in possible_locations:
+                patchfile = os.path.join(dirname, patch)
+                if os.path.exists(patchfile):
+                    break
+            else:
+                raise CommandError('Failed to find patch: %s' % patch)
+        return patchfile
+
     def _do_patches(self, buildscript):
         # now patch the working tree
         for (patch, patchstrip) in self.patches:
-            patchfile = ''
-            if urlparse(patch)[0]:
-                # patch name has scheme, get patch from network
-                try:
-                    patchfile = httpcache.load(patch, nonetwork=buildscript.config.nonetwork)
-                except urllib2.HTTPError as e:
-                    raise BuildStateError('could not download patch (error: %s)' % e.code)
-                except urllib2.URLError as e:
-                    raise BuildStateError('could not download patch')
-            elif self.repository.moduleset_uri:
-                # get it relative to the moduleset uri, either in the same
-                # directory or a patches/ subdirectory
-                for patch_prefix in ('.', 'patches', '../patches'):
-                    uri = urljoin(self.repository.moduleset_uri,
-                            os.path.join(patch_prefix, patch))
-                    try:
-                        patchfile = httpcache.load(uri, nonetwork=buildscript.config.nonetwork)
-                    except Exception as e:
-                        continue
-                    if not os.path.isfile(patchfile):
-                        continue
-                    break
-                else:
-                    patchfile = ''
-
-            if not patchfile:
-                # nothing else, use icbuild provided patches
-                possible_locations = []
-                if self.config.modulesets_dir:
-                    possible_locations.append(os.path.join(self.config.modulesets_dir, 'patches'))
-                    possible_locations.append(os.path.join(self.config.modulesets_dir, '../patches'))
-                if PKGDATADIR:
-                    possible_locations.append(os.path.join(PKGDATADIR, 'patches'))
-                if SRCDIR:
-                    possible_locations.append(os.path.join(SRCDIR, 'patches'))
-                for dirname in possible_locations:
-                    patchfile = os.path.join(dirname, patch)
-                    if os.path.exists(patchfile):
-                        break
-                else:
-                    raise CommandError('Failed to find patch: %s' % patch)
+            patchfile = self._find_patch(buildscript, patch)
 
             buildscript.set_action('Applying patch', self, action_target=patch)
             # patchfile can be a relative file
@@ -323,6 +351,21 @@ class TarballBranch(Branch):
         if self.quilt:
             self._quilt_checkout(buildscript)
 
+    def prefetch(self, buildscript):
+        # clobber mode wipes the source tree in checkout()
+        if self.checkout_mode == 'clobber':
+            return
+        if os.path.exists(self.srcdir) or not self.may_checkout(buildscript):
+            return
+        existed = os.path.exists(self.raw_srcdir)
+        try:
+            self._download_and_unpack(buildscript)
+        except:
+            # do not let checkout() mistake a partial tree for a good one
+            if not existed and os.path.exists(self.raw_srcdir):
+                shutil.rmtree(self.raw_srcdir, ignore_errors=True)
+            raise
+
     def may_checkout(self, buildscript):
         if os.path.exists(self._local_tarball):
             return True
@@ -334,13 +377,30 @@ class TarballBranch(Branch):
         md5sum = hashlib.md5()
         if self.patches:
             for patch in self.patches:
-                md5sum.update(patch[0])
+                md5sum.update(patch[0].encode('utf-8'))
         if self.quilt:
             md5sum.update(get_output('quilt files',
                         cwd=self.srcdir,
-                        extra_env={'QUILT_PATCHES' : self.quilt.srcdir}))
+                        extra_env={'QUILT_PATCHES' : self.quilt.srcdir}).encode('utf-8'))
         return '%s-%s' % (self.version, md5sum.hexdigest())
 
+    def get_build_inputs(self, buildscript):
+        # the tarball is known by its version only, and the patches by
+        # their names; an edited patch must give another input hash
+        inputs = [self.source_hash or '']
+        for (patch, patchstrip) in self.patches:
+            digest = hashlib.sha256()
+            fp = open(self._find_patch(buildscript, patch), 'rb')
+            try:
+                data = fp.read(32768)
+                while data:
+                    digest.update(data)
+                    data = fp.read(32768)
+            finally:
+                fp.close()
+            inputs.append('%s:%d:%s' % (patch, patchstrip, digest.hexdigest()))
+        return inputs
+
     def to_sxml(self):
         return ([sxml.branch(module=self.module,
                              repo=self.repository.name,
@@ -0,0 +1,333 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   test_buildscript.py: tests of the bookkeeping of BuildScript
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''The modules built here run no command; their phases are Python code
+that writes their files into the prefix.'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from icbuild.errors import SkipToEnd
+from icbuild.frontends.buildscript import BuildScript
+from icbuild.modtypes import Package, DownloadableModule
+from icbuild.moduleset import ModuleSet
+from icbuild.utils.buildjournal import BuildJournal
+
+
+class TestConfig:
+    def __init__(self, tmpdir):
+        # as made by Config.create_directories()
+        self.prefix = os.path.join(tmpdir, 'prefix')
+        self.top_builddir = os.path.join(self.prefix, '_icbuild')
+        os.makedirs(self.top_builddir)
+        self.checkoutroot = os.path.join(tmpdir, 'checkout')
+        self.buildroot = None
+        self.copy_dir = None
+        self.build_targets = ['install']
+        self.build_policy = 'updated-deps'
+        self.artifact_cache = None
+        self.max_concurrent_modules = 1
+        self.prefetch_checkouts = 0
+        self.jobs = 1
+        self.min_age = None
+        self.nopoison = False
+        self.module_nopoison = {}
+        self.exit_on_error = False
+        self.cache_max_size = None
+        self.module_extra_env = {}
+
+
+class TestBranch:
+    def __init__(self, srcdir, revision='1'):
+        self.srcdir = srcdir
+        self.revision = revision
+
+    def may_checkout(self, buildscript):
+        return True
+
+    def checkout(self, buildscript):
+        if not os.path.exists(self.srcdir):
+            os.makedirs(self.srcdir)
+
+    def tree_id(self):
+        return self.revision
+
+    def get_build_inputs(self, buildscript):
+        return []
+
+
+class TestModule(Package, DownloadableModule):
+    '''A module installing files, named after the keys of output, with
+    the values as contents.'''
+    type = 'test'
+
+    def __init__(self, config, name, dependencies=(), output=None):
+        branch = TestBranch(os.path.join(config.checkoutroot, name))
+        Package.__init__(self, name, branch=branch,
+                         dependencies=list(dependencies))
+        self.config = config
+        if output is None:
+            output = {os.path.join('lib', name): name}
+        self.output = output
+        # the phases run, the one to interrupt and the one to end the
+        # build of the module at, as the build policy does
+        self.run = []
+        self.interrupt = None
+        self.skip = None
+
+    def get_srcdir(self, buildscript):
+        return self.branch.srcdir
+
+    def get_builddir(self, buildscript):
+        return self.branch.srcdir
+
+    def _run(self, phase):
+        self.run.append(phase)
+        if self.interrupt == phase:
+            raise KeyboardInterrupt()
+        if self.skip == phase:
+            raise SkipToEnd()
+
+    def do_checkout(self, buildscript):
+        self._run('checkout')
+        DownloadableModule.do_checkout(self, buildscript)
+
+    def do_clean(self, buildscript):
+        self._run('clean')
+    do_clean.depends = ['checkout']
+
+    def do_build(self, buildscript):
+        self._run('build')
+    do_build.depends = ['checkout']
+
+    def do_install(self, buildscript):
+        self._run('install')
+        for name, data in self.output.items():
+            filename = os.path.join(self.config.prefix, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as fp:
+                fp.write(data)
+    do_install.depends = ['build']
+
+
+class TestBuildScript(BuildScript):
+    def __init__(self, config, module_list, module_set):
+        BuildScript.__init__(self, config, module_list, module_set=module_set)
+        self.messages = []
+
+    def message(self, msg, module_num=-1):
+        self.messages.append(msg)
+
+    def set_action(self, action, module, module_num=-1, action_target=None):
+        pass
+
+    def handle_error(self, module, phase, nextphase, error, altphases):
+        return 'fail'
+
+
+class BuildScriptTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = TestConfig(self.tmpdir)
+        self.module_set = ModuleSet(self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_module(self, name, dependencies=(), **kwargs):
+        module = TestModule(self.config, name, dependencies, **kwargs)
+        self.module_set.add(module)
+        return module
+
+    def build(self, names=None, journal=False):
+        if names is None:
+            names = list(self.module_set.modules.keys())
+        module_list = self.module_set.get_full_module_list(names)
+        for module in module_list:
+            # as if the modules were loaded again
+            module.run = []
+            module._input_hash = None
+        build = TestBuildScript(self.config, module_list, self.module_set)
+        build.build(journal=journal)
+        return build
+
+
+class JournalTestCase(BuildScriptTestCase):
+    def load_journal(self):
+        journal = BuildJournal(os.path.join(self.config.top_builddir, 'journal'))
+        journal.load()
+        return journal
+
+    def test_interrupted_phase_not_done(self):
+        module = self.add_module('m')
+        module.interrupt = 'build'
+        self.assertRaises(KeyboardInterrupt, self.build, journal=True)
+        self.assertEqual(self.load_journal().phases, {'m': set(['checkout'])})
+
+    def test_skipped_phase_not_done(self):
+        self.add_module('m').skip = 'build'
+        self.add_module('n', ['m']).interrupt = 'build'
+        self.assertRaises(KeyboardInterrupt, self.build, journal=True)
+        journal = self.load_journal()
+        self.assertEqual(journal.phases['m'], set(['checkout']))
+        self.assertEqual(journal.built, set(['m']))
+
+    def test_resume(self):
+        module = self.add_module('m')
+        module.interrupt = 'install'
+        self.assertRaises(KeyboardInterrupt, self.build, journal=True)
+        module.interrupt = None
+        self.config.resume = True
+        self.build(journal=True)
+        self.assertEqual(module.run, ['install'])
+
+
+class HistoryTestCase(BuildScriptTestCase):
+    def get_phases(self, build, name):
+        return [(run.phase, run.success) for run in build.history.get_runs(name)]
+
+    def test_completed_phases(self):
+        self.add_module('m')
+        build = self.build()
+        self.assertEqual(self.get_phases(build, 'm'),
+                         [('checkout', True), ('build', True), ('install', True)])
+
+    def test_interrupted_phase_not_recorded(self):
+        module = self.add_module('m')
+        module.interrupt = 'build'
+        self.assertRaises(KeyboardInterrupt, self.build)
+        build = TestBuildScript(self.config, [module], self.module_set)
+        self.assertEqual(self.get_phases(build, 'm'), [('checkout', True)])
+
+    def test_skipped_phase_not_recorded(self):
+        self.add_module('m').skip = 'checkout'
+        build = self.build()
+        self.assertEqual(self.get_phases(build, 'm'), [])
+
+
+class BuildPolicyTestCase(BuildScriptTestCase):
+    def age_packagedb(self):
+        # the dates are kept to the second: make the installs so far older
+        # than the next ones
+        for name in self.module_set.modules:
+            entry = self.module_set.packagedb.get(name)
+            entry.manifest = entry.manifest
+            for key in ('installed-date', 'changed-date'):
+                if key in entry.metadata:
+                    entry.metadata[key] -= 60
+            entry.write()
+
+    def test_hashed(self):
+        self.config.build_policy = 'hashed'
+        module = self.add_module('m')
+        self.build()
+        self.assertEqual(module.run, ['checkout', 'build', 'install'])
+        build = self.build()
+        self.assertEqual(module.run, ['checkout'])
+        self.assertTrue('Skipping m (build inputs not changed)' in build.messages)
+
+        module.branch.revision = '2'
+        self.build()
+        self.assertEqual(module.run, ['checkout', 'build', 'install'])
+
+    def test_hashed_dependency_changed(self):
+        self.config.build_policy = 'hashed'
+        dep = self.add_module('dep')
+        module = self.add_module('m', ['dep'])
+        self.build()
+        dep.branch.revision = '2'
+        self.build()
+        self.assertEqual(dep.run, ['checkout', 'build', 'install'])
+        self.assertEqual(module.run, ['checkout', 'build', 'install'])
+
+    def test_updated(self):
+        self.config.build_policy = 'updated'
+        module = self.add_module('m')
+        self.build()
+        self.build()
+        self.assertEqual(module.run, ['checkout'])
+
+    def test_updated_deps_same_output(self):
+        dep = self.add_module('dep')
+        module = self.add_module('m', ['dep'])
+        self.build()
+        self.assertEqual(self.module_set.packagedb.get('dep').manifest,
+                         [os.path.join('lib', 'dep')])
+
+        # rebuilt, installing the same files
+        self.age_packagedb()
+        self.config.build_policy = 'all'
+        self.build(['dep'])
+        self.assertEqual(dep.run, ['checkout', 'build', 'install'])
+        self.config.build_policy = 'updated-deps'
+        self.build()
+        self.assertEqual(module.run, ['checkout'])
+
+        dep.output = {os.path.join('lib', 'dep'): 'dep 2'}
+        self.age_packagedb()
+        self.config.build_policy = 'all'
+        self.build(['dep'])
+        self.config.build_policy = 'updated-deps'
+        self.build()
+        self.assertEqual(module.run, ['checkout', 'build', 'install'])
+
+
+class ArtifactTestCase(BuildScriptTestCase):
+    def setUp(self):
+        BuildScriptTestCase.setUp(self)
+        self.config.artifact_cache = os.path.join(self.tmpdir, 'artifacts')
+
+    def build_again(self):
+        # as on another host sharing the artifact cache
+        shutil.rmtree(self.config.prefix)
+        os.makedirs(self.config.top_builddir)
+        return self.build()
+
+    def test_restore(self):
+        module = self.add_module('m')
+        self.build()
+        self.build_again()
+        self.assertEqual(module.run, [])
+        with open(os.path.join(self.config.prefix, 'lib', 'm')) as fp:
+            self.assertEqual(fp.read(), 'm')
+        self.assertEqual(self.module_set.packagedb.get('m').manifest,
+                         [os.path.join('lib', 'm')])
+
+    def test_no_restore_all(self):
+        module = self.add_module('m')
+        self.build()
+        self.config.build_policy = 'all'
+        self.build_again()
+        self.assertEqual(module.run, ['checkout', 'build', 'install'])
+
+    def test_no_restore_clean(self):
+        module = self.add_module('m')
+        self.build()
+        self.config.build_targets = ['clean', 'install']
+        self.build_again()
+        self.assertEqual(module.run, ['checkout', 'clean', 'build', 'install'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   test_depresolve.py: tests of the dependency resolver
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''ModuleSet.get_full_module_list() must give the same build orders as
+the resolver it replaced, kept below as reference_module_list(), which
+is quadratic but simple.  Run with "python -m unittest discover tests".
+'''
+
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from icbuild.errors import UsageError
+from icbuild.moduleset import ModuleSet
+
+
+class TestConfig:
+    def __init__(self, modules=()):
+        self.modules = list(modules)
+
+
+class TestModule:
+    def __init__(self, name, dependencies=(), suggests=(), after=()):
+        self.name = name
+        self.dependencies = list(dependencies)
+        self.suggests = list(suggests)
+        self.after = list(after)
+        self.tags = []
+
+    def __repr__(self):
+        return '<TestModule %s>' % self.name
+
+
+def reference_module_list(module_set, module_names='all', skip=[],
+                          include_suggests=True, include_afters=False):
+    '''The resolver of ModuleSet.get_full_module_list() before it was made
+    linear, unknown module warnings left out.'''
+    modules_by_name = module_set.modules
+
+    def dep_resolve(node, resolved, seen, after):
+        circular = False
+        seen.append(node)
+        if include_suggests:
+            edges = node.dependencies + node.suggests + node.after
+        else:
+            edges = node.dependencies + node.after
+        resolved_deps = [module for module, after_module in resolved
+                         if not after_module]
+        for edge_name in edges:
+            edge = modules_by_name.get(edge_name)
+            if edge is None:
+                continue
+            if edge_name not in skip and edge not in resolved_deps:
+                if edge in seen:
+                    circular = True
+                    break
+                if edge_name in node.after:
+                    dep_resolve(edge, resolved, seen, True)
+                elif edge_name in node.suggests:
+                    dep_resolve(edge, resolved, seen, after)
+                elif edge_name in node.dependencies:
+                    dep_resolve(edge, resolved, seen, after)
+                    if edge not in [i[0] for i in resolved]:
+                        resolved.append((edge, after))
+        seen.remove(node)
+        if not circular:
+            if node not in [i[0] for i in resolved]:
+                resolved.append((node, after))
+            elif not after:
+                for index, item in enumerate(resolved):
+                    if item[1] == True and item[0] == node:
+                        resolved[index] = (node, False)
+
+    if module_names == 'all':
+        module_names = modules_by_name.keys()
+    resolved = []
+    for name in module_names:
+        if name not in skip:
+            dep_resolve(modules_by_name[name], resolved, [], False)
+    if include_afters:
+        module_list = [module for module, after_module in resolved]
+    else:
+        module_list = [module for module, after_module in resolved
+                       if not after_module]
+    if '*' in skip:
+        module_list = [module for module in module_list
+                       if module.name in module_set.config.modules]
+    return module_list
+
+
+def make_module_set(modules, config_modules=()):
+    module_set = ModuleSet(config=TestConfig(config_modules), db=object())
+    for module in modules:
+        module_set.add(module)
+    return module_set
+
+
+class DependencyResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        # unknown modules and cycles are reported through logging
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def assert_order(self, module_set, expected, *args, **kwargs):
+        module_list = module_set.get_full_module_list(*args, **kwargs)
+        names = [module.name for module in module_list]
+        reference = [module.name for module in
+                     reference_module_list(module_set, *args, **kwargs)]
+        self.assertEqual(names, reference)
+        if expected is not None:
+            self.assertEqual(names, expected)
+
+    def test_dependencies(self):
+        module_set = make_module_set([
+                TestModule('a', ['b', 'c']),
+                TestModule('b', ['d']),
+                TestModule('c', ['d']),
+                TestModule('d')])
+        self.assert_order(module_set, ['d', 'b', 'c', 'a'], ['a'])
+
+    def test_suggests(self):
+        module_set = make_module_set([
+                TestModule('a', ['b'], suggests=['c']),
+                TestModule('b'),
+                TestModule('c')])
+        self.assert_order(module_set, ['b', 'c', 'a'], ['a'])
+        self.assert_order(module_set, ['b', 'a'], ['a'],
+                          include_suggests=False)
+
+    def test_after(self):
+        module_set = make_module_set([
+                TestModule('a', ['b'], after=['c']),
+                TestModule('b', ['d']),
+                TestModule('c'),
+                TestModule('d', after=['b'])])
+        # c is only ordered, not built
+        self.assert_order(module_set, ['d', 'b', 'a'], ['a'])
+        self.assert_order(module_set, ['d', 'b', 'c', 'a'], ['a'],
+                          include_afters=True)
+        # an <after/> module that is also a dependency is built
+        self.assert_order(module_set, ['d', 'b', 'c', 'a'], ['a', 'c'])
+
+    def test_skip(self):
+        module_set = make_module_set([
+                TestModule('a', ['b']),
+                TestModule('b', ['c']),
+                TestModule('c')])
+        self.assert_order(module_set, ['a'], ['a'], ['b'])
+        self.assert_order(module_set, [], ['a'], ['a'])
+
+    def test_skip_all_but_config_modules(self):
+        module_set = make_module_set([
+                TestModule('a', ['b']),
+                TestModule('b', ['c']),
+                TestModule('c')], config_modules=['a', 'c'])
+        self.assert_order(module_set, ['c', 'a'], ['a'], ['*'])
+
+    def test_unknown_dependency(self):
+        module_set = make_module_set([TestModule('a', ['nothere'])])
+        self.assert_order(module_set, ['a'], ['a'])
+
+    def test_cycle(self):
+        module_set = make_module_set([
+                TestModule('a', ['b']),
+                TestModule('b', ['c']),
+                TestModule('c', ['a'])])
+        self.assert_order(module_set, None, ['a'])
+        module_set.raise_exception_on_warning = True
+        self.assertRaises(UsageError, module_set.get_full_module_list, ['a'])
+
+    def test_long_chain(self):
+        # deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 1000
+        names = ['m%d' % i for i in range(depth)]
+        module_set = make_module_set(
+                [TestModule(name, names[i+1:i+2]) for i, name in enumerate(names)])
+        module_list = module_set.get_full_module_list([names[0]])
+        self.assertEqual([module.name for module in module_list],
+                         list(reversed(names)))
+
+    def test_random_graphs(self):
+        rand = random.Random(0)
+        for trial in range(2000):
+            count = rand.randint(1, 20)
+            names = ['m%d' % i for i in range(count)]
+            # a fraction of the graphs have cycles
+            cyclic = rand.random() < 0.4
+            modules = []
+            for i, name in enumerate(names):
+                module = TestModule(name)
+                pool = cyclic and names or names[i+1:]
+                for kind, most in (('dependencies', 3), ('suggests', 1),
+                                   ('after', 1)):
+                    edges = getattr(module, kind)
+                    for j in range(rand.randint(0, most)):
+                        if not pool:
+                            break
+                        dep = rand.choice(pool + ['unknown'])
+                        if dep != name and dep not in edges:
+                            edges.append(dep)
+                modules.append(module)
+            module_set = make_module_set(
+                    modules, rand.sample(names, rand.randint(0, count)))
+            for include_suggests in (True, False):
+                for include_afters in (True, False):
+                    skip = rand.sample(names, rand.randint(0, min(2, count)))
+                    if rand.random() < 0.1:
+                        skip.append('*')
+                    if rand.random() < 0.1:
+                        targets = 'all'
+                    else:
+                        targets = rand.sample(names, rand.randint(1, min(3, count)))
+                    self.assert_order(module_set, None, targets, skip,
+                                      include_suggests=include_suggests,
+                                      include_afters=include_afters)
+
+
+if __name__ == '__main__':
+    unittest.main()
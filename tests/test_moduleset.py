@@ -0,0 +1,113 @@
+# icbuild - a tool to ease building collections of source packages
+#
+#   test_moduleset.py: tests of moduleset loading
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import icbuild.moduleset
+
+MODULESET = '''<?xml version="1.0"?>
+<moduleset>
+  <repository type="tarball" name="gnome-http" default="yes"
+              href="http://download.gnome.org/sources/"/>
+  <msvc id="glib">
+    <branch module="glib/2.46/glib-2.46.2.tar.xz" version="2.46.2"/>
+  </msvc>
+  <msvc id="atk">
+    <branch module="atk/2.18/atk-2.18.0.tar.xz" version="2.18.0"/>
+    <dependencies>
+      <dep package="glib"/>
+    </dependencies>
+  </msvc>
+</moduleset>
+'''
+
+
+class TestConfig:
+    '''The settings loading a moduleset uses, as in defaults.icbuildrc;
+    there is no mirror_policy.'''
+
+    def __init__(self, tmpdir):
+        self.moduleset = os.path.join(tmpdir, 'test.modules')
+        self.modulesets_dir = tmpdir
+        self.use_local_modulesets = False
+        self.nonetwork = True
+        self.lockfile = None
+        self.conditions = set()
+        self.repos = {}
+        self.branches = {}
+        self.prefix = os.path.join(tmpdir, 'prefix')
+        self.checkoutroot = os.path.join(tmpdir, 'checkout')
+        self.top_builddir = os.path.join(tmpdir, 'build')
+        self.tarballdir = os.path.join(tmpdir, 'tarballs')
+        self.cacheroot = os.path.join(tmpdir, 'cache')
+        self.cache_modulesets = True
+        self.moduleset_revalidate = 'always'
+        self.module_extra_env = {}
+        self.copy_dir = None
+        self.checkout_mode = 'update'
+        self.module_checkout_mode = {}
+
+
+class CompiledModuleSetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = TestConfig(self.tmpdir)
+        with open(self.config.moduleset, 'w') as fp:
+            fp.write(MODULESET)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        return icbuild.moduleset.load(self.config)
+
+    def test_second_load_is_compiled(self):
+        first = self.load()
+        filename = icbuild.moduleset._get_compiled_filename(
+                self.config, [self.config.moduleset])
+        self.assertTrue(os.path.exists(filename))
+
+        parse_module_set = icbuild.moduleset._parse_module_set
+        def fail(*args, **kwargs):
+            self.fail('the moduleset was parsed again')
+        icbuild.moduleset._parse_module_set = fail
+        try:
+            second = self.load()
+        finally:
+            icbuild.moduleset._parse_module_set = parse_module_set
+
+        self.assertEqual(sorted(second.modules), sorted(first.modules))
+        self.assertEqual(second.uris, first.uris)
+        self.assertEqual(second.modules['atk'].dependencies, ['glib'])
+
+    def test_changed_moduleset_is_parsed(self):
+        self.load()
+        with open(self.config.moduleset, 'w') as fp:
+            fp.write(MODULESET.replace('atk', 'pango'))
+        module_set = self.load()
+        self.assertEqual(sorted(module_set.modules), ['glib', 'pango'])
+
+
+if __name__ == '__main__':
+    unittest.main()